@@ -12,6 +12,7 @@ import os
 import sys
 import re
 import argparse
+import multiprocessing as mp
 
 smatch_pattern_name = "check_host_input"
 
@@ -21,6 +22,102 @@ tdx_allowed_drivers = ["drivers/virtio", "drivers/block/virtio_blk.c",
                        "drivers/net/tun.c", "drivers/net/tap.c", "drivers/firmware/efi",
                        "drivers/input/input.c", "drivers/tty/hvc/hvc_console.c"]
 
+ID_RE = re.compile(r"\{([A-Za-z0-9_]+)\}")
+ALLOWED_RE = re.compile("|".join(re.escape(x) for x in tdx_allowed_drivers))
+
+# size of the input chunks filtered in parallel with -p
+CHUNK_SIZE = 32 << 20
+
+
+def filter_line(line):
+    """
+    Return a report line as kept for splitting into results, or None.
+    """
+    if (not ID_RE.search(line)) and (smatch_pattern_name not in line) and ("spectre" not in line):
+        return None
+    if ("spectre" in line):
+        line = line + ";"
+    return line + "\n"
+
+
+def filter_file(input_file):
+    with open(input_file, 'r') as finput:
+        for line in finput:
+            line = filter_line(line[:-1] if line.endswith("\n") else line)
+            if line is not None:
+                yield line
+
+
+def chunk_ranges(input_file, chunk_size):
+    """
+    Split a file into (start, end) ranges of about chunk_size that end
+    after a newline.
+    """
+    size = os.path.getsize(input_file)
+    ranges = list()
+    with open(input_file, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def filter_chunk(job):
+    input_file, start, end = job
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # same newline translation as reading in text mode
+    text = data.decode().replace("\r\n", "\n").replace("\r", "\n")
+    return "".join(line for line in map(filter_line, text.split("\n")) if line is not None)
+
+
+def split_results(pieces):
+    """
+    Split the kept lines into ';'-terminated results as they complete.
+    """
+    buf = list()
+    for piece in pieces:
+        parts = piece.split(';')
+        buf.append(parts[0])
+        for part in parts[1:]:
+            yield "".join(buf)
+            buf = [part]
+    yield "".join(buf)
+
+
+def keep_result(result):
+    if ("../" in result):
+        return False  # basically dropping all relative paths now since they are duplicates
+    if result.startswith("\nsound/"):
+        return False
+    if result.startswith("\nsamples/"):
+        return False
+    if result.startswith("\ndrivers/") or result.startswith("\n./drivers/"):
+        if ("drivers/pci/controller/" in result):
+            return False
+        if not ALLOWED_RE.search(result):
+            return False
+    return True
+
+
+def write_results(output_file, pieces):
+    results_seen = set()
+    with open(output_file, 'w') as foutput_warn:
+        for result in split_results(pieces):
+            if result == "" or result == "\n" or result == ";":
+                continue
+            if result in results_seen:  # a duplicate
+                continue
+            if not keep_result(result):
+                continue
+            results_seen.add(result)
+            foutput_warn.write(result + ";")
+
 
 def main(args):
     input_file = args.input_file
@@ -39,44 +136,12 @@ def main(args):
             file=sys.stderr)
         exit(1)
 
-    with open(input_file, 'r') as finput:
-        data = finput.read()  # read the whole file and save to variable data
-    result_lines = data.split('\n')
-    data_clean = ""
-    for line in result_lines:
-        if (not re.search(r"\{([A-Za-z0-9_]+)\}", line)) and (smatch_pattern_name not in line) and ("spectre" not in line):
-            continue
-        if ("spectre" in line):
-            line = line + ";"
-        data_clean = data_clean + line + "\n"
-    #print("data_clean: " + data_clean)
-    result_list = data_clean.split(';')
-    results_seen = set()
-    with open(output_file, 'w') as foutput_warn:
-        for result in result_list:
-            if result == "" or result == "\n" or result == ";":
-                continue
-            if result in results_seen:  # a duplicate
-                continue
-            if ("../" in result):
-                continue  # basically dropping all relative paths now since they are duplicates
-            results_seen.add(result)
-            #print ("Result is " + result)
-            found = 0
-            if result.startswith("\nsound/"):
-                continue
-            if result.startswith("\nsamples/"):
-                continue
-            if result.startswith("\ndrivers/") or result.startswith("\n./drivers/"):
-                if ("drivers/pci/controller/" in result):
-                    continue
-                for x in tdx_allowed_drivers:
-                    if (x in result):
-                        found = 1
-                        break
-                if (found == 0):
-                    continue
-            foutput_warn.write(result + ";")
+    if args.p > 1:
+        jobs = [(input_file, start, end) for start, end in chunk_ranges(input_file, CHUNK_SIZE)]
+        with mp.Pool(args.p) as pool:
+            write_results(output_file, pool.imap(filter_chunk, jobs))
+    else:
+        write_results(output_file, filter_file(input_file))
 
     print(f"Wrote data to '{output_file}'", file=sys.stderr)
 
@@ -91,5 +156,7 @@ if __name__ == "__main__":
                         help='Store output to specified file')
     parser.add_argument('-f', '--force', action="store_true",
                         help='Force overwrite existing output files')
+    parser.add_argument('-p', metavar='<n>', type=int, default=1,
+                        help='Number of processes to filter large reports with')
     args = parser.parse_args()
     main(args)
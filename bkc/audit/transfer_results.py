@@ -14,6 +14,106 @@ import re
 import argparse
 
 
+ID_RE = re.compile(r"\{([A-Za-z0-9_]+)\}")
+
+
+class AnalyzedResults:
+    """
+    Previously analyzed results, parsed once and indexed by the ids they
+    contain and by (path, function), so that a new result is only compared
+    against the analyzed results that can possibly match it.
+    """
+
+    def __init__(self, result_list_analyzed):
+        self.results = list()
+        self.records = list()
+        self.by_id = dict()
+        self.by_func = dict()
+        for result_analyzed in result_list_analyzed:
+            result_analyzed = result_analyzed.strip()
+            if result_analyzed == "":
+                continue
+            i = len(self.results)
+            self.results.append(result_analyzed)
+            record = self.parse(result_analyzed)
+            self.records.append(record)
+            # any analyzed result containing a new result contains its id
+            for result_id in set(ID_RE.findall(result_analyzed)):
+                self.by_id.setdefault(result_id, list()).append(i)
+            if record:
+                self.by_func.setdefault((record['path'], record['func']), list()).append(i)
+
+    @staticmethod
+    def parse(result_analyzed):
+        path_analyzed = result_analyzed.split(':')[0]
+        tmp = result_analyzed.split('\n')[0]
+        if (tmp.find('\t') == -1):
+            status_analyzed = ""
+        else:
+            status_analyzed = tmp.split('\t')[0].strip()
+        if (len(result_analyzed.split(':')[0].split('\t')) > 1):
+            path_analyzed = result_analyzed.split(':')[0].split('\t')[1]
+        path_analyzed = path_analyzed.strip()
+        result_id_analyzed = ID_RE.search(result_analyzed)
+        if (not result_id_analyzed):
+            return None
+        if (len(result_analyzed.split(':')) < 2):
+            return None
+        func_name_analyzed = result_analyzed.split(':')[1].split(' ')[1]
+        comment_analyzed = ""
+        if (len(result_analyzed.split('\n\t')) > 2):
+            comment_analyzed = re.findall(r'\[.*?\]', result_analyzed.split('\n\t')[2])
+        return {
+            'path': path_analyzed,
+            'func': func_name_analyzed,
+            'id': result_id_analyzed.group(1),
+            'status': status_analyzed,
+            'line': result_analyzed.split(':')[1].split(' ')[0],
+            'comment': comment_analyzed,
+        }
+
+    def transfer(self, result_new, path_new, result_id_new, func_name_new):
+        """
+        Return the analyzed version of result_new, or None if there is no
+        matching analyzed result. The first match in file order is used.
+        """
+        candidates = set(self.by_id.get(result_id_new, [])) | \
+            set(self.by_func.get((path_new, func_name_new), []))
+        for i in sorted(candidates):
+            result_analyzed = self.results[i]
+            if (result_new in result_analyzed):
+                return result_analyzed
+            record = self.records[i]
+            if not record:
+                continue
+            if ((record['path'] == path_new) and (record['func'] == func_name_new)):
+                if (record['id'] != result_id_new):
+                    line_num_analyzed = record['line']
+                    line_num_new = result_new.split(':')[1].split(' ')[0]
+                    if (("read from the host using function 'native_read_msr'" in result_new) and
+                        ("read from the host using function 'paravirt_read_msr'" in result_analyzed)):
+                        # ids will be different in this case since reference results using paravirt_read_msr
+                        # so cannot tranfer based on ids, transfer based on var name and line number
+                        var_analyzed = result_analyzed.split('paravirt_read_msr\'')[1].split('\'')[1]
+                        var_new = result_new.split('native_read_msr\'')[1].split('\'')[1]
+                        if ((line_num_analyzed != line_num_new) or
+                                (var_analyzed != var_new)):
+                            continue
+                    else:
+                        # if paths and func name match, but ids dont, but we are dealing with excluded
+                        # code, we dont care, just mark the new code with same status also
+                        if (record['status'] != "excluded"):
+                            continue
+                if record['status']:
+                    result = record['status'] + "\t" + result_new
+                else:
+                    result = result_new
+                if record['comment']:
+                    result = result + "\n\t" + record['comment'][0]
+                return result
+        return None
+
+
 def main(args):
     input_analyzed = args.input_analyzed
     input_new = args.input_new
@@ -35,7 +135,7 @@ def main(args):
 
     with open(input_analyzed, 'r') as fanalysed:
         data_analyzed = fanalysed.read()
-    result_list_analyzed = data_analyzed.split(';')
+    analyzed = AnalyzedResults(data_analyzed.split(';'))
 
     with open(input_new, 'r') as fmsr:
         data_new = fmsr.read()
@@ -51,83 +151,18 @@ def main(args):
                     result_new = result_new.strip()
                     if result_new == "":
                         continue
-                    #print ("Input result is " + result_new)
-                    found = 0
                     path_new = result_new.split(':')[0]
                     path_new = path_new.strip()
-                    #print ("path_new is  " + path_new + "\n")
-                    result_id_new = re.search(
-                        r"\{([A-Za-z0-9_]+)\}", result_new)
+                    result_id_new = ID_RE.search(result_new)
                     if (not result_id_new):
                         continue
-                    #print ("result_id_new is  " + result_id_new.group(1) + "\n")
                     func_name_new = result_new.split(':')[1].split(' ')[1]
-                    for result_analyzed in result_list_analyzed:
-                        result_analyzed = result_analyzed.strip()
-                        if result_analyzed == "":
-                            continue
-                        #print ("result_analyzed is " + result_analyzed + "\n")
-                        if (result_new in result_analyzed):
-                            found = 1
-                            if args.t:
-                                foutput_old.write(result_analyzed + ";\n")
-                            foutput_analyzed.write(result_analyzed + ";\n")
-                            break
-                        path_analyzed = result_analyzed.split(':')[0]
-                        tmp = result_analyzed.split('\n')[0]
-                        if (tmp.find('\t') == -1):
-                            status_analyzed = ""
-                        else:
-                            status_analyzed = tmp.split('\t')[0].strip()
-                        #print ("status_analyzed is  " + status_analyzed + "\n")
-                        if (len(result_analyzed.split(':')[0].split('\t')) > 1):
-                            path_analyzed = result_analyzed.split(':')[0].split('\t')[1]
-                        path_analyzed = path_analyzed.strip()
-                        #print ("path_analyzed is  " + path_analyzed + "\n")
-                        result_id_analyzed = re.search(r"\{([A-Za-z0-9_]+)\}", result_analyzed)
-                        if (not result_id_analyzed):
-                            continue
-                        #print ("result_id_analyzed is  " + result_id_analyzed.group(1) + "\n")
-                        if (len(result_analyzed.split(':')) < 2):
-                            continue
-                        func_name_analyzed = result_analyzed.split(':')[1].split(' ')[1]
-                        comment_analyzed = ""
-                        if (len(result_analyzed.split('\n\t')) > 2):
-                            comment_analyzed = re.findall(r'\[.*?\]', result_analyzed.split('\n\t')[2])
-                        # if comment_analyzed:
-                            #print ("comment_analyzed is  " + comment_analyzed[0] + "\n")
-                        if ((path_analyzed == path_new) and (func_name_analyzed == func_name_new)):
-                            if (result_id_analyzed.group(1) != result_id_new.group(1)):
-                                line_num_analyzed = result_analyzed.split(':')[1].split(' ')[0]
-                                line_num_new = result_new.split(':')[1].split(' ')[0]
-                                if (("read from the host using function 'native_read_msr'" in result_new) and
-                                    ("read from the host using function 'paravirt_read_msr'" in result_analyzed)):
-                                    # ids will be different in this case since reference results using paravirt_read_msr
-                                    # so cannot tranfer based on ids, transfer based on var name and line number
-                                    var_analyzed = result_analyzed.split('paravirt_read_msr\'')[1].split('\'')[1]
-                                    var_new = result_new.split('native_read_msr\'')[1].split('\'')[1]
-                                    if ((line_num_analyzed != line_num_new) or
-                            	       (var_analyzed != var_new)):
-                            	        continue
-                                else:
-                            	    # if paths and func name match, but ids dont, but we are dealing with excluded
-                            	    # code, we dont care, just mark the new code with same status also
-                                    if (status_analyzed != "excluded"):
-                                        continue
-                            found = 1
-                            if status_analyzed:
-                                #print ("result_new is  " + result_new + "\n")
-                                result = status_analyzed + "\t" + result_new
-                            else:
-                                result = result_new
-                            if comment_analyzed:
-                                result = result + "\n\t" + comment_analyzed[0]
-                            result = result + ";\n"
-                            if args.t:
-                                foutput_old.write(result)
-                            foutput_analyzed.write(result)
-                            break
-                    if (not found):
+                    result = analyzed.transfer(result_new, path_new, result_id_new.group(1), func_name_new)
+                    if result is not None:
+                        if args.t:
+                            foutput_old.write(result + ";\n")
+                        foutput_analyzed.write(result + ";\n")
+                    else:
                         if args.t:
                             foutput_new.write(result_new + ";\n")
                         foutput_analyzed.write(result_new + ";\n")
@@ -13,18 +13,22 @@ import sys
 import argparse
 import re
 import pickle
-from itertools import groupby
-
-SMATCH_PATH = os.environ.get("SMATCH_PATH", os.path.expanduser("~/tdx/smatch"))
-smdb_available = False
-
-# smatch smdb.py - broken
-#try:
-#    sys.path.insert(0, os.path.join(SMATCH_PATH, "smatch_data/db"))
-#    import smdb
-#    smdb_available = True
-#except Exception:
-#    smdb_available = False
+import struct
+import hashlib
+import sqlite3
+import shlex
+import subprocess
+import time
+import multiprocessing as mp
+from array import array
+
+try:
+    from smatcher.linecov import parse_line_coverage_file, parse_line_coverage_buffer
+    from smatcher.reachability import load_reachable_funcs
+except ImportError:
+    # run as script from the package folder
+    from linecov import parse_line_coverage_file, parse_line_coverage_buffer
+    from reachability import load_reachable_funcs
 
 __author__ = "Sebastian Österlund <sebastian.osterlund@intel.com>"
 __email__ = "sebastian.osterlund@intel.com"
@@ -36,6 +40,9 @@ SYMBOL_NOT_COV = "-"
 SYMBOL_PARTIAL_COV = "/"
 GLOBAL_DB_FILE = os.path.expanduser("~/tdx/bkc/kafl/.global_cov.db")
 SMATCH_REACHABILITY_DB_FILE = "smatch_db.sqlite"
+# parsed smatch reports, keyed by content hash (set to empty string to disable)
+SMATCH_CACHE_DIR = os.environ.get("SMATCHER_CACHE", os.path.expanduser("~/.cache/bkc/smatcher"))
+SMATCH_CACHE_MAGIC = b"SMC1"
 IND = "  "
 
 SMATCH_CAT_CONCERN = "concern"
@@ -48,40 +55,238 @@ SMATCH_CAT_TRUSTED = "trusted"
 LINECOV_FILES = ["traces/linecov.lst", "traces/smatch_match_rust.lst",
                  "traces/smatch_match.lst", "traces/addr2line.lst"]
 
+# re-matches the traces of a workdir, refreshing the files in LINECOV_FILES
+WATCH_UPDATE_CMD = os.path.join(os.environ["BKC_ROOT"], "bkc/kafl/fuzz.sh") + " smatch" \
+    if os.environ.get("BKC_ROOT") else None
+
 KERNEL_ANALYSIS_START_FUNCS = ["start_kernel", "kernel_init"]
+KERNEL_ANALYSIS_MAX_DEPTH = 7
+
+
+def _parse_smatch_report(s):
+    entries = set()
+    # Get classified entries
+    m = re.findall("(\S+)\t(\S+:[0-9]+) (\S+)\(\)", s)
+    for c, l, f in m:
+        entries.add((c, os.path.normpath(l.strip('./')), f))
+    # Get unclassified entries
+    m = re.findall("^(\S+:[0-9]+) (\S+)\(\)", s, re.M)
+    for l, f in m:
+        if not f == "(null)":
+            entries.add((SMATCH_CAT_UNCLASSIFIED,
+                        os.path.normpath(l.strip('./')), f))
+    return entries
+
+
+def _pack_entries(entries):
+    # string table followed by one (class, line, func) triple of string ids per entry
+    strings = sorted(set(s for e in entries for s in e))
+    ids = {s: i for i, s in enumerate(strings)}
+    rows = array('I', (ids[s] for e in sorted(entries) for s in e))
+    blob = "\0".join(strings).encode()
+    return SMATCH_CACHE_MAGIC + struct.pack("<II", len(blob), len(rows)) + blob + rows.tobytes()
+
+
+def _unpack_entries(data):
+    if data[:4] != SMATCH_CACHE_MAGIC:
+        return None
+    blob_len, num = struct.unpack_from("<II", data, 4)
+    blob = data[12:12 + blob_len]
+    strings = blob.decode().split("\0") if blob_len else []
+    rows = array('I')
+    rows.frombytes(data[12 + blob_len:])
+    if len(rows) != num:
+        return None
+    it = iter([strings[i] for i in rows])
+    return set(zip(it, it, it))
+
+
+_smatch_cache = dict()
 
 
 # Returns entries in the form
 # (classification, line, function)
+#
+# Parsed reports are cached in memory and in SMATCH_CACHE_DIR, so that
+# workdirs sharing a report and repeated runs only parse it once.
 def parse_smatch_file(fname):
-    entries = set()
-    with open(fname, "r") as fh:
-        s = fh.read()
-        # Get classified entries
-        m = re.findall("(\S+)\t(\S+:[0-9]+) (\S+)\(\)", s)
-        for c, l, f in m:
-            entries.add((c, os.path.normpath(l.strip('./')), f))
-        # Get unclassified entries
-        m = re.findall("^(\S+:[0-9]+) (\S+)\(\)", s, re.M)
-        for l, f in m:
-            if not f == "(null)":
-                entries.add((SMATCH_CAT_UNCLASSIFIED,
-                            os.path.normpath(l.strip('./')), f))
+    st = os.stat(fname)
+    stamp = (os.path.realpath(fname), st.st_mtime_ns, st.st_size)
+    if stamp in _smatch_cache:
+        return _smatch_cache[stamp]
+
+    with open(fname, "rb") as fh:
+        data = fh.read()
+    digest = hashlib.sha1(data).hexdigest()
+    cache_file = os.path.join(SMATCH_CACHE_DIR, digest + ".bin") if SMATCH_CACHE_DIR else None
+
+    entries = None
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, "rb") as fh:
+            entries = _unpack_entries(fh.read())
+    if entries is None:
+        entries = _parse_smatch_report(data.decode())
+        if cache_file:
+            try:
+                os.makedirs(SMATCH_CACHE_DIR, exist_ok=True)
+                # per-process temp file, pool workers may fill the cache at once
+                tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+                with open(tmp_file, "wb") as fh:
+                    fh.write(_pack_entries(entries))
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                print(f"Could not write smatch cache '{cache_file}': {e}", file=sys.stderr)
+
+    entries = frozenset(entries)
+    _smatch_cache[stamp] = entries
     return entries
 
 
-def parse_line_coverage_file(fname):
-    lines = set()
-    with open(fname, "r") as fh:
-        try:
-            s = fh.read()
-            m = re.findall("[\w./]+:[0-9]+", s)
-            for l in m:
-                lines.add(os.path.normpath(l.strip('./')))
-        except UnicodeDecodeError as e:
-            print(f"Error decoding file {fname}: {e}", file=sys.stderr)
-            pass
-    return lines
+class CoverageDB:
+    """
+    Global coverage of smatch entries across campaigns, in SQLite.
+
+    Each saved run records the entries it covered as hits of a named
+    campaign, optionally tagged with a kernel version. The database uses
+    WAL mode, so that concurrent pipeline jobs can save their results.
+    A pickled set of entries found at the db path (the format used by
+    earlier versions) is imported as campaign 'legacy'.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            class TEXT NOT NULL,
+            line TEXT NOT NULL,
+            func TEXT NOT NULL,
+            UNIQUE (class, line, func));
+        CREATE INDEX IF NOT EXISTS entries_line ON entries (line);
+        CREATE INDEX IF NOT EXISTS entries_func ON entries (func);
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            kernel TEXT,
+            created REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS hits (
+            entry INTEGER NOT NULL REFERENCES entries (id),
+            campaign INTEGER NOT NULL REFERENCES campaigns (id),
+            time REAL NOT NULL,
+            PRIMARY KEY (entry, campaign)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS hits_campaign ON hits (campaign, entry);
+    """
+
+    def __init__(self, db_file):
+        legacy = None
+        if os.path.isfile(db_file):
+            with open(db_file, "rb") as fh:
+                # empty if just created by a concurrent job
+                header = fh.read(16)
+                if header and header != b"SQLite format 3\0":
+                    fh.seek(0)
+                    legacy = pickle.load(fh)
+            if legacy is not None:
+                os.replace(db_file, db_file + ".pickle")
+                print(f"Converting pickled db to SQLite, old db kept as '{db_file}.pickle'", file=sys.stderr)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+
+        self.conn = sqlite3.connect(db_file, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+        if legacy is not None:
+            self.add("legacy", None, legacy)
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, campaign, kernel, entries):
+        """
+        Record entries as covered by campaign. Entries already covered by
+        the campaign keep the time they were first recorded.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO campaigns (name, kernel, created) VALUES (?, ?, ?)",
+                              (campaign, kernel, now))
+            if kernel:
+                self.conn.execute("UPDATE campaigns SET kernel = ? WHERE name = ?", (kernel, campaign))
+            self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS cov (class TEXT, line TEXT, func TEXT)")
+            self.conn.execute("DELETE FROM cov")
+            self.conn.executemany("INSERT INTO cov VALUES (?, ?, ?)", entries)
+            self.conn.execute("INSERT OR IGNORE INTO entries (class, line, func) SELECT * FROM cov")
+            self.conn.execute("""
+                INSERT OR IGNORE INTO hits (entry, campaign, time)
+                SELECT entries.id, campaigns.id, ? FROM cov
+                JOIN entries USING (class, line, func)
+                JOIN campaigns ON campaigns.name = ?""", (now, campaign))
+            self.conn.execute("DELETE FROM cov")
+
+    def covered(self):
+        return set(self.conn.execute(
+            "SELECT class, line, func FROM entries WHERE id IN (SELECT entry FROM hits)"))
+
+    def campaigns(self):
+        """
+        Return (name, kernel, created, number of covered entries) of all campaigns.
+        """
+        return self.conn.execute("""
+            SELECT name, kernel, created, COUNT(entry) FROM campaigns
+            LEFT JOIN hits ON hits.campaign = campaigns.id
+            GROUP BY campaigns.id ORDER BY created""").fetchall()
+
+    def first_cover(self, key):
+        """
+        Return (class, line, func, campaign, kernel, time) of the first hit
+        of each entry in function or source line key.
+        """
+        # bare columns of a MIN() aggregate are taken from the minimum row
+        return self.conn.execute("""
+            SELECT class, line, func, campaigns.name, campaigns.kernel, MIN(hits.time) FROM entries
+            JOIN hits ON hits.entry = entries.id
+            JOIN campaigns ON campaigns.id = hits.campaign
+            WHERE entries.func = ?1 OR entries.line = ?1
+            GROUP BY entries.id ORDER BY line""", (key,)).fetchall()
+
+    def kernel_entries(self, kernel):
+        return set(self.conn.execute("""
+            SELECT class, line, func FROM entries WHERE id IN (
+                SELECT entry FROM hits JOIN campaigns ON campaigns.id = hits.campaign
+                WHERE campaigns.kernel = ?)""", (kernel,)))
+
+
+def print_db_queries(args):
+    db = CoverageDB(args.db_file)
+    if args.campaigns:
+        for name, kernel, created, num in db.campaigns():
+            print("{} {:<30} {:<20} {:8d} entries".format(
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(created)), name, kernel or "-", num))
+    if args.first_cover:
+        for c, l, f, name, kernel, t in db.first_cover(args.first_cover):
+            print("{} {} {}() first covered by '{}' ({}) at {}".format(
+                c, l, f, name, kernel or "-", time.strftime("%Y-%m-%d %H:%M", time.localtime(t))))
+    if args.delta:
+        old = db.kernel_entries(args.delta[0])
+        new = db.kernel_entries(args.delta[1])
+        for c, l, f in sorted(new - old):
+            print(f"{SYMBOL_COV} {c} {l} {f}()")
+        for c, l, f in sorted(old - new):
+            print(f"{SYMBOL_NOT_COV} {c} {l} {f}()")
+        print(IND + "Covered only by '{}': {}, only by '{}': {}".format(
+            args.delta[1], len(new - old), args.delta[0], len(old - new)))
+    db.close()
+
+
+def index_entries(entries):
+    """
+    Index (class, line, func) entries by class and by function. The lists
+    keep the iteration order of entries.
+    """
+    by_class = dict()
+    by_func = dict()
+    for e in entries:
+        by_class.setdefault(e[0], []).append(e)
+        by_func.setdefault(e[2], []).append(e)
+    return by_class, by_func
 
 
 def try_find_smatch_file(args, input_item):
@@ -155,43 +360,364 @@ def try_get_coverage(args, input_item):
     return cov
 
 
-def start(args):
-    covered = set()
-    if args.load:
-        with open(args.db_file, "rb") as fh:
-            covered |= pickle.load(fh)
-            print("Loaded %d lines from db" % len(covered), file=sys.stderr)
+_smatch_line_maps = dict()
 
-    smatch_set = set()
-    for input_item in args.input_items:
-        cov = try_get_coverage(args, input_item)
-        smatch_file = try_find_smatch_file(args, input_item)
-        if smatch_file is None:
-            continue
-        sm = parse_smatch_file(smatch_file)
-        smatch_set |= sm
+
+def smatch_line_map(smatch_file):
+    """
+    Return a map of source line to the entries of a smatch report.
+    """
+    sm = parse_smatch_file(smatch_file)
+    # workdirs of a campaign usually share the same report
+    sm_map = _smatch_line_maps.get(sm, None)
+    if sm_map is None:
         sm_map = dict()
         for (c, l, f) in sm:
             e = sm_map.get(l, set())
             e.add((c, l, f))
             sm_map[l] = e
+        _smatch_line_maps[sm] = sm_map
+    return sm_map
 
-        for line in cov:
-            e = sm_map.get(line, set())
-            if len(e) > 0:
-                covered |= e
+
+def match_input_item(args, input_item):
+    """
+    Match the line coverage of an input item against its smatch report.
+    Returns the report file and the covered entries.
+    """
+    covered = set()
+    cov = try_get_coverage(args, input_item)
+    smatch_file = try_find_smatch_file(args, input_item)
+    if smatch_file is None:
+        return None, covered
+
+    sm_map = smatch_line_map(smatch_file)
+    for line in cov:
+        e = sm_map.get(line, set())
+        if len(e) > 0:
+            covered |= e
+    return smatch_file, covered
+
+
+def _match_input_item_job(job):
+    # pass errors to the parent, a worker exiting would stall the pool
+    try:
+        return match_input_item(*job)
+    except SystemExit as e:
+        return e, None
+
+
+def match_input_items(args):
+    """
+    Run match_input_item() for all input items in parallel. Returns a list of
+    (input item, report file, covered entries), skipping items without report.
+    """
+    jobs = [(args, input_item) for input_item in args.input_items]
+    nproc = min(args.p, len(jobs))
+    if nproc > 1:
+        with mp.Pool(nproc) as pool:
+            results = pool.map(_match_input_item_job, jobs)
+    else:
+        results = map(_match_input_item_job, jobs)
+
+    matched = list()
+    for input_item, (smatch_file, cov) in zip(args.input_items, results):
+        if isinstance(smatch_file, SystemExit):
+            raise smatch_file
+        if smatch_file is not None:
+            matched.append((input_item, smatch_file, cov))
+    return matched
+
+
+class CoverageWatcher:
+    """
+    Incremental matching of the line coverage files of running workdirs.
+
+    The coverage files are only written when the traces of a workdir are
+    matched, so update() runs args.watch_update on each workdir first.
+    Each poll only parses the lines appended to a coverage file since the
+    last poll. Files that were replaced or rewritten are parsed again from
+    the start; coverage only grows, so this does not count entries twice.
+    """
+
+    # size of the fingerprint taken before the read offset of a file
+    FINGERPRINT = 4096
+
+    def __init__(self, args):
+        self.args = args
+        self.items = list()
+        self.files = dict()
+        self.covered = set()
+        self.smatch_set = set()
+        self.new_entries = list()
+
+        for input_item in args.input_items:
+            smatch_file = try_find_smatch_file(args, input_item)
+            if smatch_file is None:
+                continue
+            self.smatch_set |= parse_smatch_file(smatch_file)
+            self.items.append((input_item, smatch_line_map(smatch_file)))
+
+        self.class_total = dict()
+        self.class_covered = dict()
+        for c, l, f in self.smatch_set:
+            self.class_total[c] = self.class_total.get(c, 0) + 1
+
+    def coverage_files(self, input_item):
+        if os.path.isfile(input_item):
+            return [input_item]
+        files = [os.path.join(input_item, f) for f in LINECOV_FILES
+                 if os.path.isfile(os.path.join(input_item, f))]
+        return files if self.args.combine_cov_files else files[:1]
+
+    def update(self):
+        """
+        Run the update command on each workdir, to match its new traces.
+        """
+        if not self.args.watch_update:
+            return
+        for input_item, _ in self.items:
+            if not os.path.isdir(input_item):
+                continue
+            cmd = shlex.split(self.args.watch_update) + [input_item]
+            ret = subprocess.run(cmd, stdout=subprocess.DEVNULL).returncode
+            if ret != 0:
+                print(f"Update of '{input_item}' failed with exit code {ret}", file=sys.stderr)
+
+    def read_new_data(self, path):
+        """
+        Return the complete lines appended to path since the last call.
+        """
+        try:
+            fh = open(path, "rb")
+        except OSError:
+            return b""
+        with fh:
+            st = os.fstat(fh.fileno())
+            inode, offset, fingerprint = self.files.get(path, (st.st_ino, 0, b""))
+            if inode != st.st_ino or offset > st.st_size:
+                offset = 0
+            elif offset > 0:
+                fh.seek(offset - len(fingerprint))
+                if fh.read(len(fingerprint)) != fingerprint:
+                    offset = 0
+            fh.seek(offset)
+            data = fh.read()
+
+        # keep a partial last line for the next poll
+        end = data.rfind(b"\n") + 1
+        data = data[:end]
+        offset += end
+        if end:
+            fingerprint = data[-self.FINGERPRINT:]
+        self.files[path] = (st.st_ino, offset, fingerprint)
+        return data
+
+    def poll(self):
+        """
+        Match new coverage lines and return the number of newly covered entries.
+        """
+        num = 0
+        for input_item, sm_map in self.items:
+            for path in self.coverage_files(input_item):
+                for line in parse_line_coverage_buffer(self.read_new_data(path)):
+                    for e in sm_map.get(line, ()):
+                        if e in self.covered:
+                            continue
+                        self.covered.add(e)
+                        self.class_covered[e[0]] = self.class_covered.get(e[0], 0) + 1
+                        self.new_entries.append((time.time(), e))
+                        num += 1
+        return num
+
+    def write_summary(self, fname, since):
+        """
+        Write per-class coverage and the entries covered after time since.
+        """
+        with open(fname + ".tmp", "w") as fh:
+            print("Smatch coverage at {}".format(time.strftime("%Y-%m-%d %H:%M:%S")), file=fh)
+            print(IND + "Covered smatch entries: {}/{}".format(len(self.covered), len(self.smatch_set)), file=fh)
+            cov_non_excl = 0
+            total_non_excl = 0
+            for cl in [SMATCH_CAT_SAFE, SMATCH_CAT_CONCERN, SMATCH_CAT_WRAPPER, SMATCH_CAT_EXCLUDED, SMATCH_CAT_TRUSTED, SMATCH_CAT_UNCLASSIFIED]:
+                covered = self.class_covered.get(cl, 0)
+                total = self.class_total.get(cl, 0)
+                if cl not in ["excluded", "wrapper", "unclassified"]:
+                    cov_non_excl += covered
+                    total_non_excl += total
+                cov_pctg = 100 * covered/total if total > 0 else 0
+                print(IND + "Covered '{}' smatch entries: {}/{} => {:.2f}%".format(cl, covered, total, cov_pctg), file=fh)
+            total_cov_pctg = 100 * cov_non_excl/total_non_excl if total_non_excl > 0 else 0
+            print(IND + "Total coverage (disregard 'unclassified', 'exclude', and 'wrapper' entries): {}/{} => {:.2f}%".format(cov_non_excl, total_non_excl, total_cov_pctg), file=fh)
+
+            print(f"\nNewly covered '{SMATCH_CAT_CONCERN}' entries:", file=fh)
+            for t, (c, l, f) in reversed(self.new_entries):
+                if t <= since:
+                    break
+                if c == SMATCH_CAT_CONCERN:
+                    print("{}{} {} {}()".format(IND, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)), l, f), file=fh)
+        os.replace(fname + ".tmp", fname)
+
+
+def watch(args):
+    watcher = CoverageWatcher(args)
+    if not args.watch_update:
+        print("No --watch-update command, coverage files must be refreshed by other means "
+              "(e.g. 'fuzz.sh smatch <workdir>')", file=sys.stderr)
+    watcher.update()
+    watcher.poll()
+    start_time = time.time()
+    print(f"Watching {len(watcher.items)} input items, writing summary to '{args.watch_output}'", file=sys.stderr)
+    try:
+        while True:
+            watcher.write_summary(args.watch_output, start_time)
+            time.sleep(args.watch_interval)
+            watcher.update()
+            num = watcher.poll()
+            if num:
+                print(f"Covered {num} new smatch entries", file=sys.stderr)
+    except KeyboardInterrupt:
+        watcher.write_summary(args.watch_output, start_time)
+
+
+def harness_name(input_item):
+    # kAFL workdirs of a campaign are <campaign>/<harness>/workdir_*
+    if os.path.isfile(input_item):
+        return input_item
+    return os.path.basename(os.path.dirname(os.path.realpath(input_item)))
+
+
+def popcount(bits):
+    return bin(bits).count("1")
+
+
+def min_harness_cover(rows):
+    """
+    Greedy set cover of the union of rows. Returns the selected harnesses.
+    """
+    total = 0
+    for bits in rows.values():
+        total |= bits
+    covered = 0
+    selected = list()
+    while covered != total:
+        name, bits = max(rows.items(), key=lambda r: popcount(r[1] & ~covered))
+        selected.append(name)
+        covered |= bits
+    return selected
+
+
+def matrix(args, matched, out=sys.stdout):
+    """
+    Attribute the covered smatch entries of the match_input_items() results
+    to harnesses, using one row of bits per harness with a column per covered
+    entry. The report is printed to out.
+    """
+    class_re = re.compile(args.class_filter) if len(args.class_filter) > 0 else None
+
+    harness_entries = dict()
+    for input_item, smatch_file, cov in matched:
+        entries = harness_entries.setdefault(harness_name(input_item), set())
+        entries |= set(e for e in cov if not class_re or class_re.match(e[0]))
+
+    columns = sorted(set().union(*harness_entries.values()))
+    col = {e: i for i, e in enumerate(columns)}
+    rows = dict()
+    for name, entries in sorted(harness_entries.items()):
+        bits = bytearray((len(columns) + 7) // 8)
+        for e in entries:
+            bits[col[e] >> 3] |= 1 << (col[e] & 7)
+        rows[name] = int.from_bytes(bits, "little")
+
+    def row_entries(bits):
+        return [columns[i] for i, b in enumerate(bin(bits)[:1:-1]) if b == "1"]
+
+    # union of all other rows, from prefix and suffix unions
+    names = list(rows)
+    prefix = [0]
+    for name in names:
+        prefix.append(prefix[-1] | rows[name])
+    suffix = [0]
+    for name in reversed(names):
+        suffix.append(suffix[-1] | rows[name])
+    suffix.reverse()
+    unique = {name: rows[name] & ~(prefix[i] | suffix[i + 1]) for i, name in enumerate(names)}
+
+    concern = 0
+    for i, e in enumerate(columns):
+        if e[0] == SMATCH_CAT_CONCERN:
+            concern |= 1 << i
+
+    print("##############", file=out)
+    print("HARNESS MATRIX:", file=out)
+    print("##############", file=out)
+    print(IND + "{} harnesses x {} covered smatch entries".format(len(rows), len(columns)), file=out)
+    print(IND + "{:<40} {:>8} {:>8} {:>8} {:>8}".format("harness", "covered", "concern", "unique", "uniq/con"), file=out)
+    for name in names:
+        print(IND + "{:<40} {:>8} {:>8} {:>8} {:>8}".format(
+            name, popcount(rows[name]), popcount(rows[name] & concern),
+            popcount(unique[name]), popcount(unique[name] & concern)), file=out)
+
+    print("\nPairwise overlap (shared entries, % of the smaller harness):", file=out)
+    overlaps = list()
+    for i, a in enumerate(names):
+        for b in names[i + 1:]:
+            shared = popcount(rows[a] & rows[b])
+            smaller = min(popcount(rows[a]), popcount(rows[b]))
+            overlaps.append((100 * shared/smaller if smaller else 0, shared, a, b))
+    for pctg, shared, a, b in sorted(overlaps, reverse=True):
+        print(IND + "{:.2f}% {} {} {}".format(pctg, shared, a, b), file=out)
+
+    selected = min_harness_cover(rows)
+    print("\nMinimal harness set covering all {} entries ({} of {} harnesses):".format(
+        len(columns), len(selected), len(rows)), file=out)
+    for name in selected:
+        print(IND + name, file=out)
+    redundant = [name for name in names if name not in selected]
+    if redundant:
+        print("Redundant harnesses: {}".format(" ".join(redundant)), file=out)
+
+    if args.only_summary:
+        return
+    for name in names:
+        if not unique[name]:
+            continue
+        print(f"\nEntries only covered by {name}:", file=out)
+        for c, l, f in row_entries(unique[name]):
+            print(f"{IND*2}{SYMBOL_COV} {c} {l} {f}()", file=out)
+
+
+def start(args):
+    covered = set()
+    loaded = set()
+    db = CoverageDB(args.db_file) if args.load or args.save else None
+    if args.load:
+        loaded = db.covered()
+        print("Loaded %d lines from db" % len(loaded), file=sys.stderr)
+
+    smatch_set = set()
+    matched = match_input_items(args)
+    for input_item, smatch_file, cov in matched:
+        smatch_set |= parse_smatch_file(smatch_file)
+        covered |= cov
+    if args.matrix_output:
+        with open(args.matrix_output, "w") as out:
+            matrix(args, matched, out)
     if args.save:
-        # Load DB, so we merge the coverage
-        if os.path.isfile(args.db_file):
-            with open(args.db_file, "rb") as fh:
-                covered |= pickle.load(fh)
-        with open(args.db_file, "wb+") as fh:
-            pickle.dump(covered, fh)
+        campaign = args.campaign or os.path.commonpath([os.path.realpath(i) for i in args.input_items])
+        db.add(campaign, args.kernel_version, covered)
+        # Report the merged coverage
+        loaded = db.covered()
+    if db:
+        db.close()
+    covered |= loaded
 
     not_covered = smatch_set - covered
     covered_funcs = set([f for c, l, f in covered])
     not_covered_funcs = set([f for c, l, f in not_covered]) - covered_funcs
     partially_covered_funcs = set([f for c, l, f in not_covered]) & covered_funcs
+    covered_by_class, covered_by_func = index_entries(covered)
+    not_covered_by_class, not_covered_by_func = index_entries(not_covered)
 
     print("##############")
     print("SUMMARY STATS:")
@@ -205,15 +731,15 @@ def start(args):
     cov_non_excl = []
     not_cov_non_excl = []
     for cl in [SMATCH_CAT_SAFE, SMATCH_CAT_CONCERN, SMATCH_CAT_WRAPPER, SMATCH_CAT_EXCLUDED, SMATCH_CAT_TRUSTED, SMATCH_CAT_UNCLASSIFIED]:
-        covered_class = list(filter(lambda e: e[0] == cl, covered))
-        not_covered_class = list(filter(lambda e: e[0] == cl, not_covered))
+        covered_class = covered_by_class.get(cl, [])
+        not_covered_class = not_covered_by_class.get(cl, [])
         if cl not in ["excluded", "wrapper", "unclassified"]:
             cov_non_excl.extend(covered_class)
             not_cov_non_excl.extend(not_covered_class)
         cov_pctg = 100 * len(covered_class)/(len(covered_class) + len(not_covered_class)) if len(covered_class) + len(not_covered_class) > 0 else 0
 
         cl_covered_funcs = set(map(lambda e: e[2], covered_class))
-        cl_not_covered_funcs = set(map(lambda e: e[2], filter(lambda e: e[0] == cl, not_covered))) - cl_covered_funcs
+        cl_not_covered_funcs = set(map(lambda e: e[2], not_covered_class)) - cl_covered_funcs
         cov_pctg_funcs = 100 * len(cl_covered_funcs)/(len(cl_covered_funcs) + len(cl_not_covered_funcs)) if len(cl_covered_funcs) + len(cl_not_covered_funcs) > 0 else 0
         funcs_stats_str = "functions {}/{} => {:.2f}%".format(len(cl_covered_funcs), len(cl_not_covered_funcs) + len(cl_covered_funcs), cov_pctg_funcs)
         print(IND + "Covered '{}' smatch entries: {}/{} => {:.2f}% ({})".format(cl, len(covered_class), len(covered_class) + len(not_covered_class), cov_pctg, funcs_stats_str))
@@ -233,17 +759,20 @@ def start(args):
     class_re = re.compile(class_filter) if len(class_filter) > 0 else None
     function_re = re.compile(function_filter) if len(function_filter) > 0 else None
 
-    def func_name_key(e):
-        return e[2]  # Sort by function name
+    # filters select keys of the index, not individual entries
+    classes = set(covered_by_class) | set(not_covered_by_class)
+    if class_re:
+        classes = set(filter(class_re.match, classes))
 
-    for k, v in groupby(sorted(smatch_set, key=func_name_key), func_name_key):
+    for k in sorted(set(f for c, l, f in smatch_set)):
         if function_re and not function_re.match(k):
             continue
         cov_sign = SYMBOL_PARTIAL_COV if k in partially_covered_funcs else (SYMBOL_COV if k in covered_funcs else SYMBOL_NOT_COV
                                                                             )
         # Get filtered covered and non-covered items for function
-        f_covered = list(filter(lambda e: e[2] == k and (len(class_filter) == 0 or class_re.match(e[0])) and not args.only_non_covered, covered))
-        f_not_covered = list(filter(lambda e: e[2] == k and (len(class_filter) == 0 or class_re.match(e[0])), not_covered))
+        f_covered = [] if args.only_non_covered else \
+            [e for e in covered_by_func.get(k, []) if e[0] in classes]
+        f_not_covered = [e for e in not_covered_by_func.get(k, []) if e[0] in classes]
 
         # Skip functions with no entries (e.g., due to filter)
         if len(f_covered) == 0 and len(f_not_covered) == 0:
@@ -253,7 +782,7 @@ def start(args):
         for c, l, f in sorted(f_covered):
             if print_lines and not args.only_non_covered:
                 print(f"{IND*2}{SYMBOL_COV} {c} {l}")
-        for c, l, f in filter(lambda e: e[2] == k, f_not_covered):
+        for c, l, f in f_not_covered:
             if print_lines:
                 print(f"{IND*2}{SYMBOL_NOT_COV} {c} {l}")
 
@@ -266,13 +795,13 @@ def start(args):
 
         s_safe = set()
         s_safe_partial = set()
-        for c, l, f in filter(lambda e: e[0] == SMATCH_CAT_CONCERN, not_covered):
+        for c, l, f in not_covered_by_class.get(SMATCH_CAT_CONCERN, []):
             if f in not_covered_funcs:
                 s.add(f)
             else:
                 s_partial.add(f)
 
-        for c, l, f in filter(lambda e: e[0] == SMATCH_CAT_SAFE, not_covered):
+        for c, l, f in not_covered_by_class.get(SMATCH_CAT_SAFE, []):
             # Skip concern funcs
             if f in s or f in s_partial:
                 continue
@@ -297,24 +826,18 @@ def start(args):
             print(f"\t{e}")
         print()
 
-        if smdb_available and args.reachability and os.path.isfile(args.smatch_reachability_db_file):
+        if args.reachability and os.path.isfile(args.smatch_reachability_db_file):
             print(IND + f"Did not reach the following functions reachable from '{KERNEL_ANALYSIS_START_FUNCS}':")
-            print(IND + "(takes a while to generate...)")
+            reachable = load_reachable_funcs(args.smatch_reachability_db_file, KERNEL_ANALYSIS_START_FUNCS,
+                                             KERNEL_ANALYSIS_MAX_DEPTH, SMATCH_CACHE_DIR)
             # Excludes 'exclude' and 'wrapper' entries
             reachable_non_covered = set()
             non_reachable_non_covered = set()
-            for start_func in KERNEL_ANALYSIS_START_FUNCS:
-                for e in not_cov_non_excl:
-                    if smdb.is_reachable_from(start_func, e[2], max_depth=7):
-                        if e[2] in not_covered_funcs:
-                            reachable_non_covered.add(e)
-                            try:
-                                non_reachable_non_covered.remove(e)
-                            except (KeyError, ValueError):
-                                # ignore
-                                pass
-                    elif e not in reachable_non_covered:
-                        non_reachable_non_covered.add(e)
+            for e in not_cov_non_excl:
+                if e[2] not in reachable:
+                    non_reachable_non_covered.add(e)
+                elif e[2] in not_covered_funcs:
+                    reachable_non_covered.add(e)
             for f in set(map(lambda e: e[2], reachable_non_covered)):
                 print(f"{IND}{IND}- {f}")
             for f in set(map(lambda e: e[2], non_reachable_non_covered)):
@@ -331,7 +854,7 @@ def main():
         description='Smatch trace matching and analysis.\n'
         'Match line coverage file against smatch report.\n'
         '\tSymbols: [\'+\' -> covered, \'-\' -> not covered, \'/\' -> partially covered]')
-    parser.add_argument('input_items', metavar='<input_item>', type=str, nargs='+',
+    parser.add_argument('input_items', metavar='<input_item>', type=str, nargs='*',
                         help='Line coverage files or kAFL workdirs to match against smatch. \
             If a kAFL workdir, input_item should be a kAFL workdir with target  \
             in /target/ and traces in /traces/. If not used for kAFL, you need to set --smatch')
@@ -351,6 +874,8 @@ def main():
                         help=f'use the combined coverage of the files {LINECOV_FILES}')
     parser.add_argument('--ignore-errors', action="store_true",
                         help='do not exit on errors')
+    parser.add_argument('-p', metavar='<n>', type=int, default=os.cpu_count(),
+                        help='number of input items to process in parallel')
     parser.add_argument('--smatch-reachability-db-file', metavar='<db_file>', type=str, default=SMATCH_REACHABILITY_DB_FILE,
                         help=f'Global db file to use. Defaults to {GLOBAL_DB_FILE}')
     parser.add_argument('--db-file', metavar='<db_file>', type=str, default=GLOBAL_DB_FILE,
@@ -359,15 +884,54 @@ def main():
                         help='save coverage in global db')
     parser.add_argument('--load', action="store_true",
                         help='load earlier coverage from global db')
+    parser.add_argument('--campaign', metavar='<name>', type=str,
+                        help='campaign name to save coverage under. Defaults to the common path of the input items')
+    parser.add_argument('--kernel-version', metavar='<version>', type=str,
+                        help='kernel version of the saved campaign, for --delta')
+    parser.add_argument('--campaigns', action="store_true",
+                        help='list the campaigns in the global db')
+    parser.add_argument('--first-cover', metavar='<func|file:line>', type=str,
+                        help='print the first campaign in the global db that covered the entries of a function or line')
+    parser.add_argument('--delta', metavar='<version>', type=str, nargs=2,
+                        help='print the entries covered for only one of two kernel versions in the global db')
+    parser.add_argument('--matrix', action="store_true",
+                        help='attribute covered entries to harnesses: unique entries per harness, pairwise overlap '
+                             'and a minimal harness set. Workdirs are grouped by their parent folder. '
+                             'Use --class-filter to only consider some classes')
+    parser.add_argument('--matrix-output', metavar='<file>', type=str,
+                        help='also write the --matrix report to <file>, reusing the matches of this run')
+    parser.add_argument('--watch', action="store_true",
+                        help='follow the coverage files of running workdirs and keep a summary in --watch-output')
+    parser.add_argument('--watch-output', metavar='<file>', type=str, default="smatch_watch.txt",
+                        help='summary file updated in --watch mode. Defaults to smatch_watch.txt')
+    parser.add_argument('--watch-interval', metavar='<sec>', type=float, default=60,
+                        help='seconds between updates in --watch mode. Defaults to 60')
+    parser.add_argument('--watch-update', metavar='<cmd>', type=str, default=WATCH_UPDATE_CMD,
+                        help='command run with each workdir before every --watch update, to match new traces. '
+                             'Defaults to "$BKC_ROOT/bkc/kafl/fuzz.sh smatch" if BKC_ROOT is set')
     parser.add_argument('--reachability', action="store_true",
                         help='do reachability analysis on results. Requires smatch_db.sqlite in your current dir (generated using smatch_scripts/build_kernel_data.sh)')
 
     args = parser.parse_args()
 
+    if args.campaigns or args.first_cover or args.delta:
+        print_db_queries(args)
+        return
+    if not args.input_items:
+        parser.error("the following arguments are required: <input_item>")
+
     if args.smatch and not os.path.isfile(args.smatch):
         print(f"Could not find smatch report {args.smatch}", file=sys.stderr)
         sys.exit()
 
+    if args.watch:
+        watch(args)
+        return
+
+    if args.matrix:
+        matrix(args, match_input_items(args))
+        return
+
     start(args)
 
 
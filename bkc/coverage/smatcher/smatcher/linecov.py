@@ -0,0 +1,69 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and your use of them is governed by the express license under which they were provided to you ("License"). Unless the License provides otherwise, you may not use, modify, copy, publish, distribute, disclose or transmit this software or the related documents without Intel's prior written permission.
+# This software and the related documents are provided as is, with no express or implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Streaming parsers for line coverage files (linecov.lst, addr2line.lst)
+#
+# Files are scanned through mmap or line by line, so memory use depends on the
+# number of distinct locations rather than the file size. Source paths and
+# function names are interned, as the same few thousand strings repeat for
+# millions of addresses.
+#
+
+import os
+import re
+import sys
+import mmap
+
+LINE_TOKEN_RE = re.compile(rb"[\w./]+:[0-9]+")
+ADDR2LINE_RE = re.compile(r"0x([\da-f]+): ([\S]+) at ([\S]+):[0-9]+$")
+ADDR2LINE_INLINED_RE = re.compile(r" \(inlined by\) ([\S]+) at ([\S]+):[0-9]+$")
+
+
+def normalize_line(token):
+    return sys.intern(os.path.normpath(token.strip('./')))
+
+
+def parse_line_coverage_buffer(buf):
+    """
+    Return the set of normalized "file:line" locations in a bytes-like buffer.
+    """
+    raw = set(match.group() for match in LINE_TOKEN_RE.finditer(buf))
+    # most tokens are repeated, only normalize each one once
+    return set(normalize_line(token.decode()) for token in raw)
+
+
+def parse_line_coverage_file(fname):
+    """
+    Return the set of normalized "file:line" locations found in fname.
+    """
+    with open(fname, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return set()
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return parse_line_coverage_buffer(m)
+
+
+def iter_addr2line(fname):
+    """
+    Yield (addr, func, "file:line") for each location of an addr2line dump
+    generated with eu-addr2line -afi. Inlined locations are reported with
+    the address of the preceding entry.
+    """
+    addr = 0
+    with open(fname, "r") as fh:
+        for line in fh:
+            line = line.rstrip("\n")
+            m = ADDR2LINE_RE.search(line)
+            if m:
+                addr = int(m.group(1), 16)
+                yield addr, sys.intern(m.group(2)), sys.intern(m.group(3))
+                continue
+            m = ADDR2LINE_INLINED_RE.search(line)
+            if m:
+                yield addr, sys.intern(m.group(1)), sys.intern(m.group(2))
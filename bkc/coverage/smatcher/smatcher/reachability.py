@@ -0,0 +1,134 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and your use of them is governed by the express license under which they were provided to you ("License"). Unless the License provides otherwise, you may not use, modify, copy, publish, distribute, disclose or transmit this software or the related documents without Intel's prior written permission.
+# This software and the related documents are provided as is, with no express or implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Reachability of functions in the call graph of a smatch_db.sqlite
+#
+# The caller -> callee relation of the caller_info table is loaded once into
+# adjacency arrays and searched breadth-first from the start functions. The
+# resulting set of reachable functions is cached by the hash of the db. The
+# hash itself is cached by the path, size and mtime of the db, so the db is
+# only read again after it changed.
+#
+
+import os
+import sys
+import sqlite3
+import hashlib
+from array import array
+
+
+def db_digest(db_file):
+    h = hashlib.sha1()
+    with open(db_file, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _write_cache(cache_dir, cache_file, text):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # per-process temp file, concurrent smatcher runs may fill the cache at once
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        with open(tmp_file, "w") as fh:
+            fh.write(text)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print(f"Could not write reachability cache '{cache_file}': {e}", file=sys.stderr)
+
+
+def cached_db_digest(db_file, cache_dir):
+    """
+    Return db_digest(db_file), hashing the db only if its path, size or
+    mtime changed since the digest was cached.
+    """
+    st = os.stat(db_file)
+    stamp = "%s:%d:%d" % (os.path.realpath(db_file), st.st_size, st.st_mtime_ns)
+    digest_file = os.path.join(cache_dir, "db_%s.digest" % hashlib.sha1(stamp.encode()).hexdigest())
+    if os.path.isfile(digest_file):
+        with open(digest_file, "r") as fh:
+            return fh.read().strip()
+
+    digest = db_digest(db_file)
+    _write_cache(cache_dir, digest_file, digest + "\n")
+    return digest
+
+
+def load_call_graph(db_file):
+    """
+    Return the function names of the db and the callees of each function
+    in CSR form (indptr, indices) over their positions in the name list.
+    """
+    conn = sqlite3.connect("file:%s?mode=ro" % db_file, uri=True)
+    try:
+        pairs = conn.execute("SELECT DISTINCT caller, function FROM caller_info").fetchall()
+    finally:
+        conn.close()
+
+    ids = dict()
+    edges = list()
+    for caller, callee in pairs:
+        edges.append((ids.setdefault(caller, len(ids)), ids.setdefault(callee, len(ids))))
+    edges.sort()
+
+    indptr = array('I', [0] * (len(ids) + 1))
+    for caller, _ in edges:
+        indptr[caller + 1] += 1
+    for i in range(len(ids)):
+        indptr[i + 1] += indptr[i]
+    indices = array('I', (callee for _, callee in edges))
+
+    names = [None] * len(ids)
+    for name, i in ids.items():
+        names[i] = name
+    return names, indptr, indices
+
+
+def reachable_funcs(names, indptr, indices, start_funcs, max_depth):
+    """
+    Return the names of all functions reachable from start_funcs within
+    max_depth calls.
+    """
+    ids = {name: i for i, name in enumerate(names)}
+    seen = bytearray(len(names))
+    frontier = [ids[f] for f in start_funcs if f in ids]
+    for i in frontier:
+        seen[i] = 1
+
+    for _ in range(max_depth):
+        next_frontier = list()
+        for i in frontier:
+            for callee in indices[indptr[i]:indptr[i + 1]]:
+                if not seen[callee]:
+                    seen[callee] = 1
+                    next_frontier.append(callee)
+        frontier = next_frontier
+
+    return set(names[i] for i in range(len(names)) if seen[i]) | set(start_funcs)
+
+
+def load_reachable_funcs(db_file, start_funcs, max_depth, cache_dir=None):
+    """
+    Return the set of functions reachable from start_funcs in the call graph
+    of a smatch db, reusing a result cached in cache_dir for the same db.
+    """
+    cache_file = None
+    if cache_dir:
+        digest = cached_db_digest(db_file, cache_dir)
+        key = hashlib.sha1(("%s:%s:%d" % (digest, ",".join(start_funcs), max_depth)).encode()).hexdigest()
+        cache_file = os.path.join(cache_dir, "reachable_%s.lst" % key)
+    if cache_file and os.path.isfile(cache_file):
+        with open(cache_file, "r") as fh:
+            return set(fh.read().splitlines())
+
+    reachable = reachable_funcs(*load_call_graph(db_file), start_funcs, max_depth)
+
+    if cache_file:
+        _write_cache(cache_dir, cache_file, "\n".join(sorted(reachable)) + "\n")
+    return reachable
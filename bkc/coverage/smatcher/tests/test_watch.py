@@ -0,0 +1,92 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and your use of them is governed by the express license under which they were provided to you ("License"). Unless the License provides otherwise, you may not use, modify, copy, publish, distribute, disclose or transmit this software or the related documents without Intel's prior written permission.
+# This software and the related documents are provided as is, with no express or implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# --watch on a workdir whose coverage grows while it is followed
+#
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import smatcher
+
+SMATCH_REPORT = ("concern\tdrivers/x/f.c:10 f_read()\n"
+                 "concern\tdrivers/x/f.c:20 f_write()\n"
+                 "concern\tdrivers/x/f.c:30 f_probe()\n")
+
+# stands in for 'fuzz.sh smatch': resolves one more block per run
+UPDATE_SCRIPT = """
+import os, sys
+lines = os.path.join(sys.argv[1], "traces", "addr2line.lst")
+with open(lines) as f:
+    num = len(f.readlines())
+if num < 3:
+    with open(lines, "a") as f:
+        f.write("0x%016x: f at drivers/x/f.c:%d:1\\n" % (0xffffffff81000000 + num, 10 * (num + 1)))
+"""
+
+
+def make_workdir(work_dir):
+    os.makedirs(os.path.join(work_dir, "target"))
+    os.makedirs(os.path.join(work_dir, "traces"))
+    with open(os.path.join(work_dir, "target", "smatch_warns_annotated.txt"), "w") as f:
+        f.write(SMATCH_REPORT)
+    with open(os.path.join(work_dir, "traces", "addr2line.lst"), "w") as f:
+        f.write("0xffffffff81000000: f at drivers/x/f.c:10:1\n")
+
+
+def watch_args(work_dir, **kwargs):
+    args = dict(input_items=[work_dir], smatch=None, combine_cov_files=True, watch_update=None,
+                watch_output=os.path.join(work_dir, "smatch_watch.txt"), watch_interval=0.05)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_poll_appended_coverage(tmp_path, monkeypatch):
+    monkeypatch.setattr(smatcher, "SMATCH_CACHE_DIR", "")
+    work_dir = str(tmp_path)
+    make_workdir(work_dir)
+    watcher = smatcher.CoverageWatcher(watch_args(work_dir))
+    assert watcher.poll() == 1
+    assert watcher.poll() == 0
+
+    lines = os.path.join(work_dir, "traces", "addr2line.lst")
+    with open(lines, "a") as f:
+        f.write("0xffffffff81000001: f at drivers/x/f.c:20:1\n0xffffffff81000002: f at drivers/x/f.")
+    assert watcher.poll() == 1
+    # the partial last line is matched once it is complete
+    with open(lines, "a") as f:
+        f.write("c:30:1\n")
+    assert watcher.poll() == 1
+    assert [e[1] for t, e in watcher.new_entries] == ["drivers/x/f.c:10", "drivers/x/f.c:20", "drivers/x/f.c:30"]
+
+
+def test_watch_runs_update(tmp_path, monkeypatch):
+    monkeypatch.setattr(smatcher, "SMATCH_CACHE_DIR", "")
+    work_dir = str(tmp_path / "workdir")
+    make_workdir(work_dir)
+    script = tmp_path / "update.py"
+    script.write_text(UPDATE_SCRIPT)
+    args = watch_args(work_dir, watch_update="%s %s" % (sys.executable, script))
+
+    # watch() runs until interrupted
+    threading.Thread(target=smatcher.watch, args=(args,), daemon=True).start()
+    summary = ""
+    deadline = time.time() + 30
+    while time.time() < deadline and "Covered smatch entries: 3/3" not in summary:
+        time.sleep(0.05)
+        if os.path.isfile(args.watch_output):
+            with open(args.watch_output) as f:
+                summary = f.read()
+    assert "Covered smatch entries: 3/3" in summary
+    # the first update runs before watching starts, the second one while watching
+    assert "drivers/x/f.c:20 f_write()" not in summary
+    assert "drivers/x/f.c:30 f_probe()" in summary
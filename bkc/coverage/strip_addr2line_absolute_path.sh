@@ -40,4 +40,9 @@ start_kernel_addr=$(readelf -sW $kernel_obj_file | awk '$8 == "start_kernel" {pr
 file_line=$(addr2line -e $kernel_obj_file $start_kernel_addr)
 prefix=${file_line%init/main.c:*}
 escaped_prefix=$(printf '%s\n' "$prefix" | sed -e 's/[\/&]/\\&/g')
+# leave files without absolute paths untouched, so that repeated runs on a
+# growing file do not rewrite it
+if [ -n "$prefix" ] && ! grep -qF -- "$prefix" $file_to_strip; then
+	exit 0
+fi
 sed -i "s/$escaped_prefix//g" $file_to_strip
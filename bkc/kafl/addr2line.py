@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and
+# your use of them is governed by the express license under which they were
+# provided to you ("License"). Unless the License provides otherwise, you may
+# not use, modify, copy, publish, distribute, disclose or transmit this software
+# or the related documents without Intel's prior written permission.  This
+# software and the related documents are provided as is, with no express or
+# implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# In-process replacement for `eu-addr2line --pretty-print -afi`
+#
+# The DWARF line table and the nesting of (inlined) function scopes of a
+# vmlinux, plus the .symtab code symbols for addresses outside of any DWARF
+# function, are flattened into sorted address tables once per build-id and
+# cached as memory-mapped .npy files. Lookups are then binary searches over
+# these tables, so harnesses sharing the same kernel do not pay for DWARF
+# decoding again.
+#
+
+import os
+import sys
+import hashlib
+import argparse
+
+import msgpack
+import numpy as np
+
+from elftools.elf.elffile import ELFFile
+from elftools.dwarf.ranges import BaseAddressEntry
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "ADDR2LINE_CACHE", os.path.expanduser("~/.cache/bkc/addr2line"))
+
+# symbol types used for code without a DWARF subprogram, e.g. .S entry stubs
+SYMBOL_TYPES = {'STT_FUNC', 'STT_NOTYPE'}
+
+# DIEs that may contain code scopes; everything else (types etc.) is skipped
+SCOPE_TAGS = {'DW_TAG_subprogram', 'DW_TAG_inlined_subroutine'}
+WALK_TAGS = SCOPE_TAGS | {'DW_TAG_compile_unit', 'DW_TAG_partial_unit',
+                          'DW_TAG_lexical_block'}
+
+NO_ENTRY = -1
+
+
+def elf_build_id(elf):
+    section = elf.get_section_by_name('.note.gnu.build-id')
+    if section:
+        for note in section.iter_notes():
+            if note['n_type'] == 'NT_GNU_BUILD_ID':
+                return note['n_desc']
+
+    # no build-id, fall back to hashing the whole file
+    h = hashlib.sha1()
+    elf.stream.seek(0)
+    for chunk in iter(lambda: elf.stream.read(1 << 20), b''):
+        h.update(chunk)
+    return "sha1-" + h.hexdigest()
+
+
+class StringTable:
+
+    def __init__(self):
+        self.strings = list()
+        self.ids = dict()
+
+    def add(self, string):
+        sid = self.ids.get(string, None)
+        if sid is None:
+            sid = len(self.strings)
+            self.ids[string] = sid
+            self.strings.append(string)
+        return sid
+
+
+def die_name(die):
+    # follow out-of-line and inlined instances to the DIE holding the name
+    for _ in range(8):
+        attrs = die.attributes
+        if 'DW_AT_name' in attrs:
+            return attrs['DW_AT_name'].value.decode(errors='replace')
+        for ref in ('DW_AT_abstract_origin', 'DW_AT_specification'):
+            if ref in attrs:
+                die = die.get_DIE_from_attribute(ref)
+                break
+        else:
+            return None
+    return None
+
+
+def die_ranges(die, cu, cu_base, range_lists):
+    attrs = die.attributes
+    if 'DW_AT_low_pc' in attrs and 'DW_AT_high_pc' in attrs:
+        low = attrs['DW_AT_low_pc'].value
+        high = attrs['DW_AT_high_pc']
+        if high.form.startswith('DW_FORM_addr'):
+            return [(low, high.value)]
+        return [(low, low + high.value)]
+
+    if 'DW_AT_ranges' in attrs and range_lists:
+        base = cu_base
+        ranges = list()
+        for entry in range_lists.get_range_list_at_offset(attrs['DW_AT_ranges'].value, cu=cu):
+            if isinstance(entry, BaseAddressEntry):
+                base = entry.base_address
+            elif entry.is_absolute:
+                ranges.append((entry.begin_offset, entry.end_offset))
+            else:
+                ranges.append((base + entry.begin_offset, base + entry.end_offset))
+        return ranges
+    return []
+
+
+def cu_file_names(lineprog, comp_dir):
+    """
+    Full path of each entry in the file table of a line program, indexed
+    the same way as DW_AT_decl_file/DW_AT_call_file and the line table.
+    """
+    version = lineprog.header['version']
+    dirs = [d.decode(errors='replace') for d in lineprog['include_directory']]
+    names = dict()
+    for idx, entry in enumerate(lineprog['file_entry']):
+        name = entry.name.decode(errors='replace')
+        if version >= 5:
+            file_idx = idx
+            directory = dirs[entry.dir_index] if entry.dir_index < len(dirs) else comp_dir
+        else:
+            file_idx = idx + 1
+            directory = dirs[entry.dir_index - 1] if entry.dir_index > 0 else comp_dir
+        names[file_idx] = os.path.join(comp_dir, directory, name)
+    return names
+
+
+def flatten_scopes(ranges):
+    """
+    Turn nested (low, high, depth, scope) ranges into sorted, non-overlapping
+    segments, each tagged with the innermost scope covering it.
+    """
+    starts, scopes = list(), list()
+
+    def emit(pos, scope):
+        if starts and starts[-1] == pos:
+            scopes[-1] = scope
+        else:
+            starts.append(pos)
+            scopes.append(scope)
+
+    stack = list()
+    # enclosing scopes first where ranges start at the same address
+    for low, high, _, scope in sorted(ranges, key=lambda r: (r[0], r[2], -r[1])):
+        while stack and stack[-1][0] <= low:
+            end, _ = stack.pop()
+            emit(end, stack[-1][1] if stack else NO_ENTRY)
+        stack.append((high, scope))
+        emit(low, scope)
+    while stack:
+        end, _ = stack.pop()
+        emit(end, stack[-1][1] if stack else NO_ENTRY)
+
+    return (np.array(starts, dtype=np.uint64),
+            np.array(scopes, dtype=np.int64))
+
+
+def symbol_table(elf, strings):
+    """
+    Return the start, end and name id of the code symbols of an ELF file,
+    sorted by address. Sizeless symbols extend to the next symbol.
+    """
+    symtab = elf.get_section_by_name('.symtab')
+    symbols = list()
+    if symtab:
+        for sym in symtab.iter_symbols():
+            if (sym['st_info']['type'] not in SYMBOL_TYPES or not sym.name or
+                    sym['st_shndx'] in ('SHN_UNDEF', 'SHN_ABS') or sym['st_value'] == 0):
+                continue
+            # at the same address, prefer sized functions and global symbols
+            symbols.append((sym['st_value'], sym['st_size'] == 0,
+                            sym['st_info']['type'] != 'STT_FUNC',
+                            sym['st_info']['bind'] != 'STB_GLOBAL', sym.name, sym['st_size']))
+    symbols.sort()
+
+    starts, ends, names = list(), list(), list()
+    for addr, _, _, _, name, size in symbols:
+        if starts and starts[-1] == addr:
+            continue
+        starts.append(addr)
+        ends.append(addr + size)
+        names.append(strings.add(name))
+    for i in range(len(starts)):
+        if ends[i] == starts[i]:
+            ends[i] = starts[i + 1] if i + 1 < len(starts) else np.iinfo(np.uint64).max
+
+    return (np.array(starts, dtype=np.uint64),
+            np.array(ends, dtype=np.uint64),
+            np.array(names, dtype=np.int64))
+
+
+def build_tables(elf_file):
+    with open(elf_file, 'rb') as f:
+        elf = ELFFile(f)
+        if not elf.has_dwarf_info():
+            raise ValueError(f"No DWARF info in {elf_file}")
+        dwarf = elf.get_dwarf_info()
+        range_lists = dwarf.range_lists()
+        strings = StringTable()
+        sym_start, sym_end, sym_name = symbol_table(elf, strings)
+
+        lines = list()      # (addr, is_valid, file, line, column)
+        scopes = list()     # (parent, name, call_file, call_line, call_column)
+        ranges = list()     # (low, high, depth, scope)
+
+        for cu in dwarf.iter_CUs():
+            top = cu.get_top_DIE()
+            comp_dir = top.attributes.get('DW_AT_comp_dir', None)
+            comp_dir = comp_dir.value.decode(errors='replace') if comp_dir else ""
+            cu_base = top.attributes['DW_AT_low_pc'].value if 'DW_AT_low_pc' in top.attributes else 0
+
+            lineprog = dwarf.line_program_for_CU(cu)
+            files = cu_file_names(lineprog, comp_dir) if lineprog else dict()
+            file_ids = {idx: strings.add(name) for idx, name in files.items()}
+
+            if lineprog:
+                for entry in lineprog.get_entries():
+                    state = entry.state
+                    if state is None:
+                        continue
+                    if state.end_sequence:
+                        lines.append((state.address, 0, NO_ENTRY, 0, 0))
+                    else:
+                        lines.append((state.address, 1, file_ids.get(state.file, NO_ENTRY),
+                                      state.line, state.column))
+
+            # depth-first walk over code scopes, tracking the enclosing scope
+            walk = [(child, NO_ENTRY, 0) for child in top.iter_children()]
+            walk.reverse()
+            while walk:
+                die, parent, depth = walk.pop()
+                if die.tag not in WALK_TAGS:
+                    continue
+
+                scope = parent
+                if die.tag in SCOPE_TAGS:
+                    die_pcs = die_ranges(die, cu, cu_base, range_lists)
+                    if die_pcs:
+                        attrs = die.attributes
+                        name = die_name(die)
+                        call_file = NO_ENTRY
+                        if 'DW_AT_call_file' in attrs:
+                            call_file = file_ids.get(attrs['DW_AT_call_file'].value, NO_ENTRY)
+                        scope = len(scopes)
+                        depth += 1
+                        scopes.append((
+                            parent,
+                            strings.add(name) if name else NO_ENTRY,
+                            call_file,
+                            attrs['DW_AT_call_line'].value if 'DW_AT_call_line' in attrs else 0,
+                            attrs['DW_AT_call_column'].value if 'DW_AT_call_column' in attrs else 0))
+                        for low, high in die_pcs:
+                            if high > low:
+                                ranges.append((low, high, depth, scope))
+
+                children = [(child, scope, depth) for child in die.iter_children()]
+                children.reverse()
+                walk.extend(children)
+
+    # keep one line row per address, preferring real rows over sequence ends
+    line_table = np.array(lines, dtype=np.int64).reshape(-1, 5)
+    line_addrs = line_table[:, 0].astype(np.uint64)
+    order = np.lexsort((line_table[:, 1], line_addrs))
+    line_table, line_addrs = line_table[order], line_addrs[order]
+    last = np.flatnonzero(np.concatenate((line_addrs[1:] != line_addrs[:-1], [True])))
+
+    seg_start, seg_scope = flatten_scopes(ranges)
+    scope_table = np.array(scopes, dtype=np.int64).reshape(-1, 5)
+
+    return {
+        'line_addr': line_addrs[last],
+        'line_file': line_table[last, 2],
+        'line_line': line_table[last, 3],
+        'line_col': line_table[last, 4],
+        'seg_start': seg_start,
+        'seg_scope': seg_scope,
+        'scope_parent': scope_table[:, 0],
+        'scope_name': scope_table[:, 1],
+        'scope_call_file': scope_table[:, 2],
+        'scope_call_line': scope_table[:, 3],
+        'scope_call_col': scope_table[:, 4],
+        'sym_start': sym_start,
+        'sym_end': sym_end,
+        'sym_name': sym_name,
+    }, strings.strings
+
+
+class AddrResolver:
+    """
+    Resolve kernel addresses to function and file:line:column, including the
+    chain of inlined callers, from the cached tables of a vmlinux.
+    """
+
+    TABLES = ['line_addr', 'line_file', 'line_line', 'line_col',
+              'seg_start', 'seg_scope',
+              'scope_parent', 'scope_name', 'scope_call_file',
+              'scope_call_line', 'scope_call_col',
+              'sym_start', 'sym_end', 'sym_name']
+    STRINGS = "strings.msgpack"
+
+    def __init__(self, elf_file, cache_dir=DEFAULT_CACHE_DIR):
+        with open(elf_file, 'rb') as f:
+            self.build_id = elf_build_id(ELFFile(f))
+        self.elf_file = elf_file
+        self.table_dir = os.path.join(cache_dir, self.build_id)
+        self.tables = dict()
+        self.strings = list()
+
+        if not self.load():
+            print("Building address table for %s (build-id %s).." %
+                  (elf_file, self.build_id), file=sys.stderr)
+            self.save(*build_tables(elf_file))
+            self.load()
+
+    def load(self):
+        strings_file = os.path.join(self.table_dir, self.STRINGS)
+        if not os.path.isfile(strings_file) or not all(
+                os.path.isfile(os.path.join(self.table_dir, name + ".npy")) for name in self.TABLES):
+            return False
+        for name in self.TABLES:
+            self.tables[name] = np.load(os.path.join(self.table_dir, name + ".npy"), mmap_mode='r')
+        with open(strings_file, 'rb') as f:
+            self.strings = msgpack.unpackb(f.read(), raw=False)
+        return True
+
+    def save(self, tables, strings):
+        os.makedirs(self.table_dir, exist_ok=True)
+        for name in self.TABLES:
+            np.save(os.path.join(self.table_dir, name + ".npy"), tables[name])
+
+        # the string table is written last and marks the cache entry as complete
+        strings_file = os.path.join(self.table_dir, self.STRINGS)
+        with open(strings_file + ".tmp", 'wb') as f:
+            f.write(msgpack.packb(strings, use_bin_type=True))
+        os.replace(strings_file + ".tmp", strings_file)
+
+    def lookup(self, addrs):
+        """
+        Bulk lookup of the line table row, innermost scope and code symbol
+        of each address. Returns NO_ENTRY where there is no such entry.
+        """
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        t = self.tables
+
+        rows = np.searchsorted(t['line_addr'], addrs, side='right').astype(np.int64) - 1
+        valid = rows >= 0
+        valid[valid] = t['line_file'][rows[valid]] != NO_ENTRY
+        rows[~valid] = NO_ENTRY
+
+        segs = np.searchsorted(t['seg_start'], addrs, side='right').astype(np.int64) - 1
+        scopes = np.full(len(addrs), NO_ENTRY, dtype=np.int64)
+        scopes[segs >= 0] = t['seg_scope'][segs[segs >= 0]]
+
+        syms = np.searchsorted(t['sym_start'], addrs, side='right').astype(np.int64) - 1
+        found = syms >= 0
+        found[found] = addrs[found] < t['sym_end'][syms[found]]
+        syms[~found] = NO_ENTRY
+        return rows, scopes, syms
+
+    def _string(self, sid):
+        return self.strings[sid] if sid != NO_ENTRY else "??"
+
+    @staticmethod
+    def _location(filename, line, col):
+        if col:
+            return "%s:%d:%d" % (filename, line, col)
+        return "%s:%d" % (filename, line)
+
+    def resolve(self, addrs):
+        """
+        Yield (addr, [(func, location), ...]) for each address, innermost
+        function first, followed by the functions it is inlined into.
+        """
+        t = self.tables
+        rows, scopes, syms = self.lookup(addrs)
+        for addr, row, scope, sym in zip(np.asarray(addrs, dtype=np.uint64).tolist(),
+                                         rows.tolist(), scopes.tolist(), syms.tolist()):
+            if row == NO_ENTRY:
+                location = "??:0"
+            else:
+                location = self._location(self._string(int(t['line_file'][row])),
+                                          int(t['line_line'][row]), int(t['line_col'][row]))
+
+            chain = list()
+            while scope != NO_ENTRY:
+                chain.append((self._string(int(t['scope_name'][scope])), location))
+                location = self._location(self._string(int(t['scope_call_file'][scope])),
+                                          int(t['scope_call_line'][scope]),
+                                          int(t['scope_call_col'][scope]))
+                scope = int(t['scope_parent'][scope])
+            if not chain:
+                # no DWARF function, e.g. assembly code: use the ELF symbol like eu-addr2line
+                name = self._string(int(t['sym_name'][sym])) if sym != NO_ENTRY else "??"
+                chain.append((name, location))
+            yield addr, chain
+
+    def write_addr2line(self, addrs, out_file):
+        """
+        Write the resolved addresses in the format of `eu-addr2line --pretty-print -afi`.
+        """
+        with open(out_file, 'w') as f:
+            for addr, chain in self.resolve(addrs):
+                func, location = chain[0]
+                f.write("0x%016x: %s at %s\n" % (addr, func, location))
+                for func, location in chain[1:]:
+                    f.write(" (inlined by) %s at %s\n" % (func, location))
+
+
+def read_addr_list(addr_file):
+    with open(addr_file, 'r') as f:
+        return np.array([int(line, 16) for line in f if line.strip()], dtype=np.uint64)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Resolve code addresses to source lines (eu-addr2line -afi replacement).')
+    parser.add_argument('input', metavar='<addr_list>', type=str,
+                        help='file with one hex address per line (e.g. traces/blocks_uniq.lst)')
+    parser.add_argument('-e', '--elf', metavar='<vmlinux>', type=str, required=True,
+                        help='ELF file with DWARF debug info')
+    parser.add_argument('-o', '--output', metavar='<file>', type=str, required=True,
+                        help='output file in addr2line.lst format')
+    parser.add_argument('--cache-dir', metavar='<dir>', type=str, default=DEFAULT_CACHE_DIR,
+                        help=f'address table cache, keyed by build-id (default: {DEFAULT_CACHE_DIR})')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.elf):
+        sys.exit(f"Error: Could not find {args.elf}.")
+    if not os.path.isfile(args.input):
+        sys.exit(f"Error: Could not find {args.input}.")
+
+    resolver = AddrResolver(args.elf, cache_dir=args.cache_dir)
+    resolver.write_addr2line(read_addr_list(args.input), args.output)
+
+
+if __name__ == "__main__":
+    main()
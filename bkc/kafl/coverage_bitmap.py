@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and
+# your use of them is governed by the express license under which they were
+# provided to you ("License"). Unless the License provides otherwise, you may
+# not use, modify, copy, publish, distribute, disclose or transmit this software
+# or the related documents without Intel's prior written permission.  This
+# software and the related documents are provided as is, with no express or
+# implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Compressed bitmaps for block and line coverage of kAFL workdirs
+#
+# Keys are split into a high part, selecting a chunk of 2^16 keys, and a low
+# part stored within the chunk (as in Roaring bitmaps). Sparse chunks are
+# sorted uint16 arrays, dense chunks are 8KB bitsets. Block addresses are used
+# as keys directly, so the kernel text maps to a few hundred dense chunks.
+# Source lines are keyed by a hash of the file name and the line number.
+#
+
+import os
+import sys
+import re
+import hashlib
+import argparse
+
+import msgpack
+import numpy as np
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+# chunks with more entries than this are stored as bitset
+ARRAY_MAX = 4096
+
+LINE_BITS = 20
+
+BLOCKS_BITMAP = "traces/blocks.bitmap"
+LINES_BITMAP = "traces/lines.bitmap"
+
+
+def _to_bits(chunk):
+    if chunk.dtype == np.uint64:
+        return chunk
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[chunk] = True
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+def _normalize(bits):
+    """
+    Return the compact form of a bitset chunk, or None if it is empty.
+    """
+    values = np.flatnonzero(np.unpackbits(bits.view(np.uint8), bitorder='little'))
+    if len(values) == 0:
+        return None
+    if len(values) > ARRAY_MAX:
+        return bits
+    return values.astype(np.uint16)
+
+
+def _cardinality(chunk):
+    if chunk.dtype == np.uint64:
+        return int(np.unpackbits(chunk.view(np.uint8)).sum())
+    return len(chunk)
+
+
+def line_key(lino):
+    """
+    Key of a "file:line" source location. The file name is hashed to 44 bits,
+    so keys are stable across workdirs without a shared file table.
+    """
+    filename, _, line = lino.rpartition(':')
+    digest = hashlib.blake2b(filename.encode(), digest_size=8).digest()
+    file_hash = int.from_bytes(digest, 'little') >> LINE_BITS
+    return (file_hash << LINE_BITS) | (int(line) & ((1 << LINE_BITS) - 1))
+
+
+class CoverageBitmap:
+    """
+    Set of uint64 keys with fast union (|), intersection (&) and
+    difference (-), and a compact serialization.
+    """
+
+    def __init__(self, chunks=None):
+        self.chunks = chunks or dict()
+
+    @classmethod
+    def from_array(cls, keys):
+        keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        highs = keys >> np.uint64(CHUNK_BITS)
+        lows = (keys & np.uint64(CHUNK_SIZE - 1)).astype(np.uint16)
+        uniq, starts = np.unique(highs, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+
+        chunks = dict()
+        for high, start, end in zip(uniq.tolist(), starts.tolist(), ends.tolist()):
+            chunk = lows[start:end]
+            chunks[high] = _to_bits(chunk) if len(chunk) > ARRAY_MAX else chunk
+        return cls(chunks)
+
+    @classmethod
+    def from_lines(cls, linos):
+        return cls.from_array(np.fromiter((line_key(lino) for lino in linos), dtype=np.uint64))
+
+    def to_array(self):
+        parts = list()
+        for high in sorted(self.chunks):
+            chunk = self.chunks[high]
+            if chunk.dtype == np.uint64:
+                chunk = np.flatnonzero(np.unpackbits(chunk.view(np.uint8), bitorder='little'))
+            parts.append((np.uint64(high) << np.uint64(CHUNK_BITS)) | chunk.astype(np.uint64))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint64)
+
+    def __len__(self):
+        return sum(_cardinality(chunk) for chunk in self.chunks.values())
+
+    def __contains__(self, key):
+        chunk = self.chunks.get(int(key) >> CHUNK_BITS, None)
+        if chunk is None:
+            return False
+        low = int(key) & (CHUNK_SIZE - 1)
+        if chunk.dtype == np.uint64:
+            return bool((int(chunk[low >> 6]) >> (low & 63)) & 1)
+        pos = np.searchsorted(chunk, low)
+        return pos < len(chunk) and chunk[pos] == low
+
+    def __eq__(self, other):
+        if self.chunks.keys() != other.chunks.keys():
+            return False
+        return all(np.array_equal(_to_bits(chunk), _to_bits(other.chunks[high]))
+                   for high, chunk in self.chunks.items())
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for high, chunk in other.chunks.items():
+            mine = chunks.get(high, None)
+            if mine is None:
+                chunks[high] = chunk
+            elif mine.dtype == np.uint16 and chunk.dtype == np.uint16 and \
+                    len(mine) + len(chunk) <= ARRAY_MAX:
+                chunks[high] = np.union1d(mine, chunk)
+            else:
+                chunks[high] = _normalize(_to_bits(mine) | _to_bits(chunk))
+        return CoverageBitmap(chunks)
+
+    def __and__(self, other):
+        chunks = dict()
+        for high in self.chunks.keys() & other.chunks.keys():
+            mine, theirs = self.chunks[high], other.chunks[high]
+            if mine.dtype == np.uint16 and theirs.dtype == np.uint16:
+                chunk = np.intersect1d(mine, theirs)
+                chunk = chunk if len(chunk) else None
+            else:
+                chunk = _normalize(_to_bits(mine) & _to_bits(theirs))
+            if chunk is not None:
+                chunks[high] = chunk
+        return CoverageBitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = dict()
+        for high, mine in self.chunks.items():
+            theirs = other.chunks.get(high, None)
+            if theirs is None:
+                chunks[high] = mine
+                continue
+            if mine.dtype == np.uint16 and theirs.dtype == np.uint16:
+                chunk = np.setdiff1d(mine, theirs)
+                chunk = chunk if len(chunk) else None
+            else:
+                chunk = _normalize(_to_bits(mine) & ~_to_bits(theirs))
+            if chunk is not None:
+                chunks[high] = chunk
+        return CoverageBitmap(chunks)
+
+    def to_bytes(self):
+        return msgpack.packb({
+            'chunks': [[high, chunk.dtype == np.uint64, chunk.tobytes()]
+                       for high, chunk in sorted(self.chunks.items())],
+        }, use_bin_type=True)
+
+    @classmethod
+    def from_bytes(cls, data):
+        chunks = dict()
+        for high, dense, raw in msgpack.unpackb(data, raw=False)['chunks']:
+            chunks[high] = np.frombuffer(raw, dtype=np.uint64 if dense else np.uint16)
+        return cls(chunks)
+
+    def save(self, path):
+        with open(path + ".tmp", 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read())
+
+
+def parse_addr2line_lines(addr2line_file):
+    """
+    Return the set of "file:line" locations listed in an addr2line.lst.
+    """
+    linos = set()
+    with open(addr2line_file, 'r') as f:
+        for line in f:
+            m = re.search(r" at ([\S]+):([0-9]+)(:[0-9]+)?$", line)
+            if m and m.group(1) != "??":
+                linos.add("%s:%s" % (m.group(1), m.group(2)))
+    return linos
+
+
+def load_workdir_bitmap(work_dir, lines=False):
+    """
+    Load the block or line coverage bitmap of a workdir. The line bitmap is
+    built from addr2line.lst on first use.
+    """
+    if not lines:
+        path = os.path.join(work_dir, BLOCKS_BITMAP)
+        if not os.path.isfile(path):
+            sys.exit(f"Error: Could not find {path}, run smatch_match.py --update-index first.")
+        return CoverageBitmap.load(path)
+
+    path = os.path.join(work_dir, LINES_BITMAP)
+    addr2line = os.path.join(work_dir, "traces", "addr2line.lst")
+    if os.path.isfile(path) and (not os.path.isfile(addr2line) or
+                                 os.path.getmtime(path) >= os.path.getmtime(addr2line)):
+        return CoverageBitmap.load(path)
+    if not os.path.isfile(addr2line):
+        sys.exit(f"Error: Could not find {addr2line}.")
+    bitmap = CoverageBitmap.from_lines(parse_addr2line_lines(addr2line))
+    bitmap.save(path)
+    return bitmap
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Combine the block or line coverage of kAFL workdirs.')
+    parser.add_argument('op', choices=['union', 'intersect', 'diff'],
+                        help='union of all inputs, coverage common to all inputs, '
+                             'or coverage of the first input not seen in the others')
+    parser.add_argument('inputs', metavar='<work_dir|bitmap>', type=str, nargs='+',
+                        help='kAFL workdirs or saved bitmap files')
+    parser.add_argument('-l', '--lines', action='store_true',
+                        help='use line coverage instead of block coverage')
+    parser.add_argument('-o', '--output', metavar='<file>', type=str,
+                        help='save the resulting bitmap')
+    args = parser.parse_args()
+
+    bitmaps = list()
+    for item in args.inputs:
+        if os.path.isdir(item):
+            bitmaps.append(load_workdir_bitmap(item, args.lines))
+        elif os.path.isfile(item):
+            bitmaps.append(CoverageBitmap.load(item))
+        else:
+            sys.exit(f"Error: Could not find {item}.")
+
+    result = bitmaps[0]
+    for bitmap in bitmaps[1:]:
+        if args.op == 'union':
+            result = result | bitmap
+        elif args.op == 'intersect':
+            result = result & bitmap
+        else:
+            result = result - bitmap
+
+    kind = "lines" if args.lines else "blocks"
+    for item, bitmap in zip(args.inputs, bitmaps):
+        print("%8d %s in %s" % (len(bitmap), kind, item))
+    print("%8d %s in %s" % (len(result), kind, args.op))
+
+    if args.output:
+        result.save(args.output)
+        print("Result written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and
+# your use of them is governed by the express license under which they were
+# provided to you ("License"). Unless the License provides otherwise, you may
+# not use, modify, copy, publish, distribute, disclose or transmit this software
+# or the related documents without Intel's prior written permission.  This
+# software and the related documents are provided as is, with no express or
+# implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Distill the corpus of traced kAFL workdirs into a seed directory
+#
+# Selects a small set of payloads that still covers every edge seen in the
+# traces, using a weighted greedy set cover (lower weight and more new edges
+# are preferred). Since every covered block and smatch location is part of a
+# covered edge, their coverage is preserved as well.
+#
+# The edges of each payload are read from the trace index. Only regular
+# payloads are used by default, crashing or hanging ones can be added with
+# --include.
+#
+# The output uses the layout expected by init_harness.py --seeds, with one
+# <out_dir>/<harness>/ folder per harness.
+#
+
+import os
+import sys
+import heapq
+import shutil
+import argparse
+
+import numpy as np
+
+from trace_index import TraceIndex, edge_ids
+from workdir_manifest import load_nodes
+
+EXIT_REASONS = ['crash', 'kasan', 'timeout']
+
+
+def payload_reason(trace):
+    # payloads are stored as corpus/<exit_reason>/payload_<nid>
+    return os.path.basename(os.path.dirname(trace['payload']))
+
+
+def payload_weight(nodes, trace, weight):
+    if weight == 'size':
+        return max(1, trace['payload_size'])
+    if weight == 'time':
+        node = nodes.get(trace['nid'], None)
+        if not node or node['performance'] is None:
+            sys.exit(f"Error: Could not find exec time of payload {trace['payload']}.")
+        return max(1e-6, node['performance'])
+    return 1
+
+
+def collect_payloads(work_dirs, weight, reasons):
+    """
+    Return the traced payloads of the given workdirs and exit reasons as a
+    list of (payload path, weight, edges), with edges as rows of (src, dst).
+    """
+    payloads = list()
+    for work_dir in work_dirs:
+        index = TraceIndex(os.path.join(work_dir, "traces", "index"))
+        if not index.load():
+            sys.exit(f"Error: Could not find trace index in {work_dir}, "
+                     "run smatch_match.py --update-index first.")
+
+        # identical traces may only have their edges listed once
+        listed = dict()
+        for rank, trace in enumerate(index.traces):
+            if trace['valid'] and len(index.trace_edges(rank)):
+                listed.setdefault(trace['hash'], rank)
+
+        nodes = load_nodes(work_dir) if weight == 'time' else dict()
+        for trace in index.traces:
+            if not trace['valid'] or payload_reason(trace) not in reasons:
+                continue
+            if trace['hash'] not in listed:
+                continue
+            payloads.append((os.path.join(work_dir, trace['payload']),
+                             payload_weight(nodes, trace, weight),
+                             index.trace_edges(listed[trace['hash']])))
+    return payloads
+
+
+def greedy_cover(sets, weights, num_elements):
+    """
+    Weighted greedy set cover with lazy re-evaluation of the gains.
+    sets are arrays of element ids. Returns the selected set indices.
+    """
+    covered = np.zeros(num_elements, dtype=bool)
+    heap = [(-len(s) / w, i) for i, (s, w) in enumerate(zip(sets, weights))]
+    heapq.heapify(heap)
+
+    selected = list()
+    while heap and not covered.all():
+        _, i = heapq.heappop(heap)
+        gain = np.count_nonzero(~covered[sets[i]])
+        if gain == 0:
+            continue
+
+        # gains only shrink, so a set still best after updating its gain is the best overall
+        score = -gain / weights[i]
+        if heap and score > heap[0][0]:
+            heapq.heappush(heap, (score, i))
+            continue
+
+        covered[sets[i]] = True
+        selected.append(i)
+    return selected
+
+
+def distill(out_dir, harness, work_dirs, weight, reasons):
+    payloads = collect_payloads(work_dirs, weight, reasons)
+    if not payloads:
+        print(f"{harness}: No traced payloads found, skipping..")
+        return
+
+    # map edges to ids in the union of all edges seen for this harness
+    all_edges = np.unique(np.concatenate([edges for _, _, edges in payloads]), axis=0)
+    sets = [edge_ids(all_edges, edges) for _, _, edges in payloads]
+    weights = [w for _, w, _ in payloads]
+
+    selected = greedy_cover(sets, weights, len(all_edges))
+
+    seed_dir = os.path.join(out_dir, harness)
+    shutil.rmtree(seed_dir, ignore_errors=True)
+    os.makedirs(seed_dir)
+    for i in selected:
+        payload = payloads[i][0]
+        target = os.path.join(seed_dir, os.path.basename(payload))
+        if os.path.exists(target):
+            # same payload name in different workdirs of this harness
+            target = os.path.join(seed_dir, "%d_%s" % (i, os.path.basename(payload)))
+        shutil.copy(payload, target)
+
+    total_weight = sum(weights)
+    kept_weight = sum(weights[i] for i in selected)
+    print(f"{harness}: Kept {len(selected)} of {len(payloads)} payloads "
+          f"({100*kept_weight/total_weight:.1f}% of total {weight}), "
+          f"covering all {len(all_edges)} edges in {seed_dir}")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Distill traced kAFL corpora into a minimal seed directory.')
+    parser.add_argument('out_dir', metavar='<out_dir>', type=str,
+                        help='output seed directory (as recognized by init_harness.py --seeds)')
+    parser.add_argument('work_dirs', metavar='<work_dir>', type=str, nargs='+',
+                        help='kAFL workdirs with an up to date trace index')
+    parser.add_argument('--harness', metavar='<name>', type=str,
+                        help='harness name (default: name of the folder holding each workdir)')
+    parser.add_argument('--weight', choices=['size', 'time', 'none'], default='size',
+                        help='prefer payloads with smaller size, lower exec time, or neither (default: size)')
+    parser.add_argument('--include', metavar='<reasons>', type=str, default="",
+                        help='also use payloads with these exit reasons, e.g. "crash,kasan,timeout" '
+                             '(default: regular payloads only)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='replace existing seed folders in <out_dir>')
+
+    args = parser.parse_args()
+
+    reasons = ['regular']
+    for reason in filter(None, args.include.split(',')):
+        if reason not in EXIT_REASONS:
+            sys.exit(f"Error: Unknown exit reason '{reason}', expected one of {', '.join(EXIT_REASONS)}.")
+        reasons.append(reason)
+
+    harnesses = dict()
+    for work_dir in args.work_dirs:
+        if not os.path.isdir(os.path.join(work_dir, "traces")):
+            sys.exit(f"Error: Could not find traces in {work_dir}.")
+        harness = args.harness or os.path.basename(os.path.dirname(os.path.realpath(work_dir)))
+        harnesses.setdefault(harness, list()).append(work_dir)
+
+    # a re-run must not mix old seeds with the new ones
+    for harness in harnesses:
+        seed_dir = os.path.join(args.out_dir, harness)
+        if os.path.isdir(seed_dir) and os.listdir(seed_dir) and not args.overwrite:
+            sys.exit(f"Error: Seed folder {seed_dir} is not empty, use --overwrite to replace it.")
+
+    for harness, work_dirs in harnesses.items():
+        distill(args.out_dir, harness, work_dirs, args.weight, reasons)
+
+
+if __name__ == "__main__":
+    main()
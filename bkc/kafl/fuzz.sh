@@ -356,11 +356,15 @@ function smatch_match()
 		# match smatch report against line coverage reported in addr2line.lst
 		SMATCH_OUTPUT=$WORK_DIR/traces/smatch_match.lst
 
+		# fold any new traces into the trace index and refresh edge/block lists
+		$BKC_ROOT/bkc/kafl/smatch_match.py $WORK_DIR --update-index
 		$BKC_ROOT/bkc/kafl/gen_addr2line.sh $WORK_DIR
 		# Make paths relative
 		$BKC_ROOT/bkc/coverage/strip_addr2line_absolute_path.sh $WORK_DIR/target/vmlinux $WORK_DIR/traces/addr2line.lst
 
 		$BKC_ROOT/bkc/kafl/smatch_match.py $WORK_DIR |sort -u > $SMATCH_OUTPUT
+		# time to first coverage of each smatch location
+		$BKC_ROOT/bkc/kafl/smatch_match.py $WORK_DIR --timeline
 		echo "Discovered smatch matches: $(wc -l $SMATCH_OUTPUT)"
 	fi
 
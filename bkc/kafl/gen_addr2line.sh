@@ -14,12 +14,20 @@
 #
 # Set USE_GHIDRA=1 to generate the complete dump of covered addresses and
 # corresponding larger (and very redundant) addr2line list. (slow)
+#
+# Set USE_ADDR2LINE_CACHE=1 to resolve addresses with addr2line.py, which
+# caches the decoded DWARF tables of each vmlinux by build-id.
+#
+# On a workdir, an existing addr2line list is extended with the blocks that
+# were indexed since it was generated, so repeated runs on a running campaign
+# only resolve the new blocks. Ghidra dumps are not extended.
 
 set -e
 set -u
 set -o pipefail
 
 USE_GHIDRA="${USE_GHIDRA:-0}"
+USE_ADDR2LINE_CACHE="${USE_ADDR2LINE_CACHE:-0}"
 
 function fatal()
 {
@@ -28,7 +36,12 @@ function fatal()
 	exit
 }
 
-which eu-addr2line || fatal "Could not find eu-addr2line...exit.."
+if test $USE_ADDR2LINE_CACHE -gt 0; then
+	ADDR2LINE="$(dirname $(realpath $0))/addr2line.py"
+	test -f $ADDR2LINE || fatal "Could not find $ADDR2LINE...exit.."
+else
+	which eu-addr2line || fatal "Could not find eu-addr2line...exit.."
+fi
 
 if test $USE_GHIDRA -gt 0; then
 	GHIDRA_RUNNER="$(realpath -e -- "$KAFL_ROOT/fuzzer/scripts/ghidra_run.sh")"
@@ -54,7 +67,14 @@ else
 	fatal "Expected first argument to be target workdir or lz4 payload trace."
 fi
 
-test -f $LINES_LIST && echo "Output $LINES_LIST already exists. Skipping.." && exit
+APPEND=0
+if test -f $LINES_LIST; then
+	if [ ! -d $INPUT ] || test $USE_GHIDRA -gt 0 || test -f $ADDR_LIST; then
+		echo "Output $LINES_LIST already exists. Skipping.."
+		exit
+	fi
+	APPEND=1
+fi
 
 TARGET_ELF=$WORK_DIR/target/vmlinux
 test -f $TARGET_ELF || fatal "Could not find $TARGET_ELF in provided workdir.."
@@ -62,7 +82,13 @@ test -f $TARGET_ELF || fatal "Could not find $TARGET_ELF in provided workdir.."
 echo "Using unique edges from $EDGE_LIST"
 
 if [ -d $INPUT ]; then
-	sed -e 's/\,/\n/' -e 's/\,.*$//' $EDGE_LIST|sort |uniq > $BLOCK_LIST
+	# smatch_match.py -t writes the block list along with the edge list
+	if test $BLOCK_LIST -nt $EDGE_LIST; then
+		echo "Using unique blocks from $BLOCK_LIST"
+	else
+		# drop the pseudo-addresses of trace splice points, they are not code
+		sed -e 's/\,/\n/' -e 's/\,.*$//' $EDGE_LIST|sort |uniq |sed -e '/^[0-9a-f]\{8\}ffffffff$/d' > $BLOCK_LIST
+	fi
 else
 	sed -e 's/\,/\n/' -e 's/\,.*$//' $EDGE_LIST > $BLOCK_LIST
 fi
@@ -84,8 +110,31 @@ else
 	fi
 fi
 
-echo "Generating addr2line dump for seen code locations.."
 test -f $ADDR_LIST || ADDR_LIST=$BLOCK_LIST
-eu-addr2line --pretty-print -afi -e $TARGET_ELF < $ADDR_LIST > $LINES_LIST || echo "Ignoring addr2line failure :-/" >&2
+OUTPUT_LIST=$LINES_LIST
+if test $APPEND -gt 0; then
+	# only resolve the blocks not yet listed in the existing output
+	NEW_LIST=$WORK_DIR/traces/blocks_new.lst
+	OUTPUT_LIST=$WORK_DIR/traces/addr2line_new.lst
+	LC_ALL=C comm -23 <(LC_ALL=C sort -u $BLOCK_LIST) \
+		<(sed -n 's/^0x\([0-9a-f]*\): .*/\1/p' $LINES_LIST | LC_ALL=C sort -u) > $NEW_LIST
+	echo "Output $LINES_LIST already exists, adding $(wc -l < $NEW_LIST) new blocks.."
+	ADDR_LIST=$NEW_LIST
+fi
+
+echo "Generating addr2line dump for seen code locations.."
+if test $USE_ADDR2LINE_CACHE -gt 0; then
+	python3 $ADDR2LINE -e $TARGET_ELF -o $OUTPUT_LIST $ADDR_LIST || echo "Ignoring addr2line failure :-/" >&2
+else
+	eu-addr2line --pretty-print -afi -e $TARGET_ELF < $ADDR_LIST > $OUTPUT_LIST || echo "Ignoring addr2line failure :-/" >&2
+fi
+
+if test $APPEND -gt 0; then
+	# make the new paths relative before appending, so that the existing
+	# lines are never rewritten and readers can follow the file as it grows
+	$(dirname $(realpath $0))/../coverage/strip_addr2line_absolute_path.sh $TARGET_ELF $OUTPUT_LIST
+	cat $OUTPUT_LIST >> $LINES_LIST
+	rm -f $NEW_LIST $OUTPUT_LIST
+fi
 
 echo "Generated addr2line table: $(wc -l $LINES_LIST)"
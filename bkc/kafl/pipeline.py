@@ -206,7 +206,10 @@ def task_smatcher(args, pipeline):
     # smacher report
     with open(args.campaign_root/'smatch_errors.txt', 'w') as logfile:
         with open(args.campaign_root/'smatch_report.txt', 'w') as report:
-            subprocess.run(['smatcher', '--combine-cov-files'] + [p['work_dir'] for p in pipeline],
+            # also write the per-harness attribution of the covered entries
+            subprocess.run(['smatcher', '--combine-cov-files',
+                            '--matrix-output', args.campaign_root/'smatch_matrix.txt'] +
+                           [p['work_dir'] for p in pipeline],
                            shell=False, check=True, cwd=args.campaign_root,
                            stdout=report, stderr=logfile)
 
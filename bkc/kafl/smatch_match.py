@@ -18,13 +18,25 @@ import sys
 
 import time
 import glob
+import json
+import hashlib
+import shutil
 import msgpack
 import lz4.frame as lz4
+import numpy as np
 import re
 import multiprocessing as mp
 
 from operator import itemgetter
 
+from smatcher.linecov import iter_addr2line
+
+from coverage_bitmap import CoverageBitmap
+from workdir_manifest import load_nodes
+from trace_index import (BackEdgeIndex, CallGraphIndex, TraceIndex, EXIT_IP, EXIT_EDGE_ID,
+                         first_seen_key, smallest_payload_key, merge_partials, spill_partial,
+                         sort_rows)
+
 
 import argparse
 
@@ -34,7 +46,14 @@ def read_binary_file(filename):
         return f.read()
 
 
-EXIT_IP = 0xffffffffffffffff
+# decompressed bytes to read from a trace file at a time
+TRACE_CHUNK_SIZE = 1 << 20
+
+# memory taken by a parsed trace, relative to its compressed size
+PARSE_MEMORY_FACTOR = 32
+
+# rows of the index tables to write to the reports at a time
+REPORT_BLOCK_ROWS = 1 << 20
 
 # default smatch_warns.txt to use if nothing in $WORKDIR/target/
 DEFAULT_SMATCH_FILE = os.path.expandvars("$BKC_ROOT/smatch_warns.txt")
@@ -42,22 +61,59 @@ DEFAULT_SMATCH_FILE = os.path.expandvars("$BKC_ROOT/smatch_warns.txt")
 # should reset this between different trace startpoints (-f)
 
 
+def rank_counts(first, num_ranks, block_rows):
+    """
+    Count the entries of a first-seen table by the rank of their trace.
+    """
+    counts = np.zeros(num_ranks, dtype=np.int64)
+    for lo in range(0, len(first), block_rows):
+        counts += np.bincount(np.asarray(first[lo:lo+block_rows]) >> 32, minlength=num_ranks)[:num_ranks]
+    return counts
+
+
+def budget_chunks(jobs, chunksize, budget, sizes):
+    """
+    Split jobs into contiguous chunks of at most chunksize jobs, whose traces
+    of the given compressed sizes fit into a worker's memory budget.
+    """
+    chunks = list()
+    chunk = list()
+    used = 0
+    for job, size in zip(jobs, sizes):
+        need = size * PARSE_MEMORY_FACTOR
+        if chunk and (len(chunk) >= chunksize or used + need > budget):
+            chunks.append(chunk)
+            chunk = list()
+            used = 0
+        chunk.append(job)
+        used += need
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
 class TraceParser:
 
     def __init__(self, trace_dir):
         self.trace_dir = trace_dir
-        self.known_bbs = set()
-        self.known_edges = set()
-        self.trace_results = list()
-        self.unique_edges = dict()
-        self.unique_bbs = set()
-        self.callers = dict()
+        self.trace_timestamps = list()
+        self.unique_edges = np.zeros((0, 2), dtype=np.uint64)
+        self.unique_edges_first = np.zeros(0, dtype=np.int64)
+        self.unique_edges_hits = np.zeros(0, dtype=np.uint64)
+        self.unique_bbs = np.zeros(0, dtype=np.uint64)
+        self.unique_bbs_first = np.zeros(0, dtype=np.int64)
+        self.unique_bbs_smallest = np.zeros(0, dtype=np.int64)
+        self.block_pos = None
+        self.block_starts = None
+        self.index = TraceIndex(trace_dir + "/index")
+        self.back_edges = BackEdgeIndex(trace_dir + "/index")
+        self.caller_order = None
+        self.caller_dsts = None
         self.addr2lifu = dict()
         self.line2addr = dict()
         self.func2addr = dict()
         self.smatch_func_map = dict()
         self.smatch_lino_map = dict()
-        self.global_back_edges = dict()
         self.seen_edges = set()
         self.func_matches = dict()
         self.lino_matches = dict()
@@ -70,17 +126,29 @@ class TraceParser:
         return addr is not None and addr != 0xffffffffffffffff
 
     def get_prior_edge_str(self, edge_str):
-        return self.global_back_edges[edge_str]
+        src, dst = self.edge_str_to_tuple(edge_str)
+        for src, dst in self.get_prior_edge(src, dst):
+            yield self.edge_to_str(src, dst)
 
     def get_prior_edge(self, src, dst):
-        # search backward through all collected traces - slooow
-        edge_str = "%016x,%016x" % (src, dst)
-        for prior_edge_str in self.global_back_edges[edge_str]:
-            src, dst = prior_edge_str.split(',')
-            yield ([int(src, 16), int(dst, 16)])
+        # search backward through the back-edge index of all collected traces
+        for prior_id in self.back_edges.priors(self.back_edges.edge_id(src, dst)).tolist():
+            if prior_id == EXIT_EDGE_ID:
+                yield ([EXIT_IP, EXIT_IP])
+            else:
+                yield (list(self.back_edges.edge(prior_id)))
 
     def addr2caller(self, addr):
-        return self.callers.get(addr, [None])
+        # edges ordered by target, only built for the callsite trace
+        if self.caller_order is None:
+            self.caller_order = np.argsort(self.unique_edges[:, 1], kind='stable')
+            self.caller_dsts = self.unique_edges[self.caller_order, 1]
+        key = np.uint64(addr)
+        lo = np.searchsorted(self.caller_dsts, key, side='left')
+        hi = np.searchsorted(self.caller_dsts, key, side='right')
+        if lo == hi:
+            return [None]
+        return self.unique_edges[self.caller_order[lo:hi], 0].tolist()
 
     def addr2line(self, addr):
         if addr < 0xffffffff00000000:
@@ -109,6 +177,64 @@ class TraceParser:
         src, dst = edge_str.split(',')
         return [int(src, 16), int(dst, 16)]
 
+    @staticmethod
+    def trace_arrays(findings):
+        """
+        Convert the edges and blocks of a parsed trace to integer arrays,
+        keeping the order in which they were first seen in the trace.
+        """
+        edges = findings['edges']
+        keys = np.fromiter((int(x, 16) for edge in edges for x in edge.split(',')),
+                           dtype=np.uint64, count=2*len(edges)).reshape(-1, 2)
+        hits = np.fromiter(edges.values(), dtype=np.uint64, count=len(edges))
+        bbs = np.fromiter(findings['bbs'], dtype=np.uint64, count=len(findings['bbs']))
+        return keys, hits, bbs
+
+    @staticmethod
+    def back_edge_array(back_edges):
+        """
+        Convert a back_edges dict to rows of (src, dst, prior_src, prior_dst).
+        """
+        num = sum(len(priors) for priors in back_edges.values())
+        return np.fromiter(
+            (int(x, 16)
+             for edge, priors in back_edges.items()
+             for prior in priors
+             for x in (edge + ',' + prior).split(',')),
+            dtype=np.uint64, count=4*num).reshape(-1, 4)
+
+    @staticmethod
+    def read_trace_edges(trace_file, chunk_size=TRACE_CHUNK_SIZE):
+        """
+        Stream (src, dst, num) edges from an lz4-compressed trace file.
+
+        The trace is decompressed in chunks of chunk_size bytes, carrying an
+        incomplete last line over to the next chunk, so memory use does not
+        grow with the size of the trace.
+        """
+        tail = b''
+        with lz4.open(trace_file, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                lines = (tail + chunk).split(b'\n')
+                tail = lines.pop()
+                for line in lines:
+                    if line:
+                        yield TraceParser.parse_edge(line)
+        if tail:
+            yield TraceParser.parse_edge(tail)
+
+    @staticmethod
+    def parse_edge(line):
+        try:
+            src, dst, num = line.split(b",")
+        except ValueError:
+            src, dst = line.split(b",")
+            num = b'1'
+        return int(src, 16), int(dst, 16), int(num, 16)
+
     @staticmethod
     def parse_trace_file(trace_file):
         if not os.path.isfile(trace_file):
@@ -118,20 +244,10 @@ class TraceParser:
         bbs = set()
         edges = dict()
         callers = dict()
-        with lz4.open(trace_file, 'r') as f:
-            for line in f.read().decode(errors="ignore").splitlines():
-                try:
-                    src, dst, num = line.split(",")
-                except ValueError:
-                    src, dst = line.split(",")
-                    num = '1'
-
-                src = int(src, 16)
-                dst = int(dst, 16)
-                num = int(num, 16)
-                edges["%016x,%016x" % (src, dst)] = num
-                callers.setdefault(dst, set()).add(src)
-                bbs.update({src, dst})
+        for src, dst, num in TraceParser.read_trace_edges(trace_file):
+            edges["%016x,%016x" % (src, dst)] = num
+            callers.setdefault(dst, set()).add(src)
+            bbs.update({src, dst})
 
         return {'bbs': bbs, 'edges': edges, 'callers': callers}
 
@@ -156,60 +272,211 @@ class TraceParser:
         back_edges = dict()
         prev_ip = 0
         last_edge = "%016x,%016x" % (EXIT_IP, EXIT_IP)
-        with lz4.open(trace_file, 'r') as f:
-            for line in f.read().decode(errors="ignore").splitlines():
-                try:
-                    src, dst, num = line.split(",")
-                except ValueError:
-                    src, dst = line.split(",")
-                    num = '1'
-
-                src = int(src, 16)
-                dst = int(dst, 16)
-                num = int(num, 16)
-
-                # splice the trace at well-known entry/exit points
-                if dst == EXIT_IP:
-                    assert (prev_ip == 0)
-                    prev_ip = src
-                    # insert fake edge
-                    prev_ip = (src % 0xffffffff << 32) + 0xffffffff
-                    continue
-                if prev_ip != 0:
-                    assert (src == EXIT_IP)
-                    assert (dst != EXIT_IP)
-                    if do_splice_location(prev_ip, dst):
-                        src = prev_ip
-                        prev_ip = 0
-
-                edge_str = "%016x,%016x" % (src, dst)
-                edges[edge_str] = edges.get(edge_str, 0) + num
-                back_edges.setdefault(edge_str, set()).add(last_edge)
-                callers.setdefault(dst, set()).add(src)
-                bbs.update({src, dst})
-                last_edge = edge_str
+        for src, dst, num in TraceParser.read_trace_edges(trace_file):
+            # splice the trace at well-known entry/exit points
+            if dst == EXIT_IP:
+                assert (prev_ip == 0)
+                prev_ip = src
+                # insert fake edge
+                prev_ip = (src % 0xffffffff << 32) + 0xffffffff
+                continue
+            if prev_ip != 0:
+                assert (src == EXIT_IP)
+                assert (dst != EXIT_IP)
+                if do_splice_location(prev_ip, dst):
+                    src = prev_ip
+                    prev_ip = 0
+
+            edge_str = "%016x,%016x" % (src, dst)
+            edges[edge_str] = edges.get(edge_str, 0) + num
+            back_edges.setdefault(edge_str, set()).add(last_edge)
+            callers.setdefault(dst, set()).add(src)
+            bbs.update({src, dst})
+            last_edge = edge_str
 
         return {'bbs': bbs, 'edges': edges, 'callers': callers, 'back_edges': back_edges}
 
-    def parse_trace_list(self, nproc, input_list):
-        trace_files = list()
-        timestamps = list()
+    @staticmethod
+    def trace_digest(trace_file):
+        """
+        Hash the compressed content of a trace, to skip parsing duplicates.
+        """
+        digest = hashlib.sha1()
+        try:
+            with open(trace_file, 'rb') as f:
+                for block in iter(lambda: f.read(TRACE_CHUNK_SIZE), b''):
+                    digest.update(block)
+        except OSError:
+            # unique digest, let the parser report the missing trace
+            return "missing:" + trace_file
+        return digest.hexdigest()
+
+    @staticmethod
+    def parse_trace_chunk(chunk):
+        """
+        Parse a chunk of (ranks, trace_file, smallest) and reduce it to a
+        compact partial. ranks lists all traces with the same content as
+        trace_file, earliest first, and smallest is the smallest_payload_key()
+        among them.
+
+        Runs in the worker processes. Only the merged coverage of the chunk
+        is passed back, tagged with the first_seen_key() of each entry so
+        that the parent can still derive the per-trace coverage deltas.
+        """
+        ranks = list()
+        edge_keys, edge_hits, edge_first = list(), list(), list()
+        bb_keys, bb_first, bb_smallest = list(), list(), list()
+        back_edges, trace_edges = list(), list()
+        for copies, trace_file, smallest in chunk:
+            findings = TraceParser.parse_splice_trace_file(trace_file)
+            if not findings:
+                continue
+            keys, hits, bbs = TraceParser.trace_arrays(findings)
+            rank = copies[0]
+            ranks.extend(copies)
+            edge_keys.append(keys)
+            edge_hits.append(hits * np.uint64(len(copies)))
+            edge_first.append(first_seen_key(rank, np.arange(len(keys), dtype=np.int64)))
+            bb_keys.append(bbs)
+            bb_first.append(first_seen_key(rank, np.arange(len(bbs), dtype=np.int64)))
+            bb_smallest.append(np.full(len(bbs), smallest, dtype=np.int64))
+            back_edges.append(TraceParser.back_edge_array(findings['back_edges']))
+            trace_edges.append(np.column_stack((np.full(len(keys), rank, dtype=np.uint64), keys)))
+
+        return merge_partials([{
+            'ranks': np.array(ranks, dtype=np.int64),
+            'edges': np.concatenate(edge_keys or [np.zeros((0, 2), dtype=np.uint64)]),
+            'edges_first': np.concatenate(edge_first or [np.zeros(0, dtype=np.int64)]),
+            'edges_hits': np.concatenate(edge_hits or [np.zeros(0, dtype=np.uint64)]),
+            'bbs': np.concatenate(bb_keys or [np.zeros(0, dtype=np.uint64)]),
+            'bbs_first': np.concatenate(bb_first or [np.zeros(0, dtype=np.int64)]),
+            'bbs_smallest': np.concatenate(bb_smallest or [np.zeros(0, dtype=np.int64)]),
+            'back_edges': np.concatenate(back_edges or [np.zeros((0, 4), dtype=np.uint64)]),
+            'trace_edges': np.concatenate(trace_edges or [np.zeros((0, 3), dtype=np.uint64)]),
+        }])
+
+    @staticmethod
+    def spill_trace_chunk(job):
+        """
+        Parse a chunk like parse_trace_chunk(), but spill the partial to
+        disk as a sorted run and only return its location.
+        """
+        chunk, run_dir = job
+        return spill_partial(run_dir, TraceParser.parse_trace_chunk(chunk))
+
+    def parse_trace_list(self, nproc, input_list, memory_budget=None):
+        """
+        Fold the traces of input_list into the trace index. With a
+        memory_budget (in bytes), partials are spilled to disk and merged
+        out-of-core.
+        """
+        records = list()
+        work_dir = os.path.dirname(self.trace_dir)
 
         for input_file, nid, timestamp in input_list:
             #trace_file = self.trace_dir + "/" + os.path.basename(input_file) + ".lz4"
             trace_file = "%s/fuzz_%05d.lst.lz4" % (self.trace_dir, nid)
             if os.path.exists(trace_file):
-                trace_files.append(trace_file)
-                timestamps.append(timestamp)
+                st = os.stat(trace_file)
+                records.append({'name': os.path.basename(trace_file),
+                                'size': st.st_size, 'mtime': st.st_mtime_ns,
+                                'nid': nid, 'timestamp': timestamp, 'valid': False,
+                                'payload': os.path.relpath(input_file, work_dir),
+                                'payload_size': os.path.getsize(input_file)})
             else:
                 print("Could not find trace: %s => %s" %
                       (input_file, trace_file))
         print("Parsing trace: %s => %s" % (input_file, trace_file))
 
-        print("Parsing traces on %d/%d cores..." % (nproc, os.cpu_count()))
+        # only traces not yet in the workdir's trace index need to be parsed
+        self.index.load()
+        new_records = self.index.pending(
+            records, lambda name: TraceParser.trace_digest(os.path.join(self.trace_dir, name)))
+        ranks = self.index.add(new_records)
+        print("Found %d new traces, %d already indexed." %
+              (len(new_records), len(self.index.traces) - len(new_records)))
+
+        merged = TraceParser.parse_trace_chunk([])
+        pending = list()
         with mp.Pool(nproc) as pool:
-            self.trace_results = zip(timestamps,
-                                     pool.map(TraceParser.parse_splice_trace_file, trace_files))
+            # identical traces are parsed once, for the earliest of them
+            trace_files = [os.path.join(self.trace_dir, record['name']) for record in new_records]
+            digests = pool.map(TraceParser.trace_digest, trace_files,
+                               chunksize=max(1, -(-len(trace_files) // (4*nproc))))
+            unique = dict()
+            for rank, trace_file, digest in sorted(zip(ranks, trace_files, digests)):
+                self.index.traces[rank]['hash'] = digest
+                unique.setdefault(digest, (list(), trace_file))[0].append(rank)
+            if new_records:
+                print("Found %d unique among %d new traces (%.1f%% duplicates)." %
+                      (len(unique), len(new_records), 100 - 100*len(unique)/len(new_records)))
+
+            jobs = list()
+            for copies, trace_file in unique.values():
+                smallest = min(smallest_payload_key(self.index.traces[rank]['payload_size'], rank)
+                               for rank in copies)
+                jobs.append((copies, trace_file, smallest))
+
+            # contiguous chunks, a few per worker to balance uneven trace sizes
+            jobs.sort()
+            chunksize = max(1, -(-len(jobs) // (4*nproc)))
+            if memory_budget:
+                # also bound the traces each worker parses into one partial
+                chunks = budget_chunks(jobs, chunksize, memory_budget // nproc,
+                                       [self.index.traces[copies[0]]['size'] for copies, _, _ in jobs])
+            else:
+                chunks = [jobs[i:i+chunksize] for i in range(0, len(jobs), chunksize)]
+
+            print("Parsing traces on %d/%d cores..." % (nproc, os.cpu_count()))
+            if memory_budget:
+                # spill each partial as a sorted run, then k-way merge the runs
+                spill_dir = os.path.join(self.index.index_dir, "runs")
+                if os.path.exists(spill_dir):
+                    shutil.rmtree(spill_dir)
+                spill_jobs = [(chunk, os.path.join(spill_dir, "run_%05d" % i))
+                              for i, chunk in enumerate(chunks)]
+                run_dirs = list(pool.imap_unordered(TraceParser.spill_trace_chunk, spill_jobs))
+            else:
+                # fold partials as they arrive, keeping at most nproc of them pending
+                for partial in pool.imap_unordered(TraceParser.parse_trace_chunk, chunks):
+                    pending.append(partial)
+                    if len(pending) >= nproc:
+                        merged = merge_partials([merged] + pending)
+                        pending = list()
+
+        if memory_budget:
+            # a row with its values takes ~32 bytes, plus sorting overhead
+            block_rows = max(1024, memory_budget // (128 * (len(run_dirs) + 1)))
+            print("Merging %d runs out-of-core, %d rows per run at a time..." %
+                  (len(run_dirs), block_rows))
+            self.index.fold_runs(run_dirs, ranks, block_rows)
+            shutil.rmtree(spill_dir, ignore_errors=True)
+        else:
+            merged = merge_partials([merged] + pending)
+            back_edges = self.index.fold(merged, ranks)
+            self.index.save(back_edges)
+        self.load_index()
+
+    def load_index(self):
+        """
+        Take the merged coverage from the workdir's trace index.
+        """
+        if not self.index.load():
+            print("Could not find trace index at %s." % self.index.index_dir)
+            return False
+
+        self.unique_edges = self.index.edges
+        self.unique_edges_first = self.index.tables['edges_first']
+        self.unique_edges_hits = self.index.tables['edges_hits']
+        self.unique_bbs = self.index.tables['bbs']
+        self.unique_bbs_first = self.index.tables['bbs_first']
+        self.unique_bbs_smallest = self.index.tables['bbs_smallest']
+        self.block_pos = None
+        self.block_starts = None
+        self.trace_timestamps = self.index.timestamps()
+        self.back_edges = self.index.back_edges
+        self.caller_order = None
+        return True
 
     def parse_addr2line(self):
         # parse addr2line DB generated from eu-addr2line -afi < unique_edges.lst
@@ -220,108 +487,241 @@ class TraceParser:
             sys.exit(1)
 
         #print("Parsing addr2line dump at %s" % addr2line)
-        addr = 0
-        with open(addr2line, 'r') as f:
-            for line in f.read().splitlines():
-                m = re.search("0x([\da-f]+): ([\S]+) at ([\S]+):[0-9]+$", line)
-                if m:
-                    addr = int(m.group(1), 16)
-                    func = m.group(2)
-                    lino = m.group(3)
-                    #print(f"parse addr2line: {line}: '{func}' @ '{lino}'")
-                    self.addr2lifu[addr] = (lino, func)
-                    self.line2addr.setdefault(lino, list()).append(addr)
-                    self.func2addr.setdefault(func, set()).add(addr)
-                else:
-                    m = re.search(
-                        " \(inlined by\) ([\S]+) at ([\S]+):[0-9]+$", line)
-                    if m:
-                        # addr = previous addr
-                        func = m.group(1)
-                        lino = m.group(2)
-                        #print(f"parse addr2line: {line}: '{func}' @ '{lino}'")
-                        self.addr2lifu[addr] = (lino, func)
-                        self.line2addr.setdefault(lino, list()).append(addr)
-                        self.func2addr.setdefault(func, set()).add(addr)
-
-    def gen_reports(self):
+        for addr, func, lino in iter_addr2line(addr2line):
+            self.addr2lifu[addr] = (lino, func)
+            self.line2addr.setdefault(lino, list()).append(addr)
+            self.func2addr.setdefault(func, set()).add(addr)
+
+    def gen_reports(self, memory_budget=None):
 
         plot_file = self.trace_dir + "/coverage.csv"
         edges_file = self.trace_dir + "/edges_uniq.lst"
+        blocks_file = self.trace_dir + "/blocks_uniq.lst"
+        bitmap_file = self.trace_dir + "/blocks.bitmap"
 
-        with open(plot_file, 'w') as f:
-            num_bbs = 0
-            num_edges = 0
-            num_traces = 0
-            for timestamp, findings in self.trace_results:
-                if not findings:
-                    continue
+        timestamps = self.trace_timestamps
 
-                new_bbs = len(findings['bbs'] - self.unique_bbs)
-                new_edges = len(set(findings['edges']) - set(self.unique_edges))
-                self.unique_bbs.update(findings['bbs'])
-                # self.callers.update(findings['callers'])
-                for dst, srcs in findings['callers'].items():
-                    self.callers.setdefault(dst, set()).update(srcs)
-                edges = findings['edges']
-                for edge, num in edges.items():
-                    self.unique_edges[edge] = self.unique_edges.get(edge, 0) + num
-                back_edges = findings['back_edges']
-                for dst, src_set in back_edges.items():
-                    self.global_back_edges.setdefault(dst, set()).update(src_set)
-
-                num_traces += 1
-                num_bbs += new_bbs
-                num_edges += new_edges
-                f.write("%d;%d;%d\n" % (timestamp, num_bbs, num_edges))
+        # the memory-mapped tables are processed in blocks of rows
+        block_rows = max(1024, memory_budget // 128) if memory_budget else REPORT_BLOCK_ROWS
 
-        with open(edges_file, 'w') as f:
-            for edge, num in self.unique_edges.items():
-                f.write("%s,%x\n" % (edge, num))
+        # cumulative coverage: every unique entry is new in the trace that saw it first
+        num_ranks = timestamps[-1][0] + 1 if timestamps else 0
+        cum_bbs = np.cumsum(rank_counts(self.unique_bbs_first, num_ranks, block_rows))
+        cum_edges = np.cumsum(rank_counts(self.unique_edges_first, num_ranks, block_rows))
 
+        with open(plot_file, 'w') as f:
+            for rank, timestamp in timestamps:
+                f.write("%d;%d;%d\n" % (timestamp, int(cum_bbs[rank]), int(cum_edges[rank])))
+
+        # edges in first-seen order, sorted out-of-core with a memory budget
+        sort_dir = os.path.join(self.index.index_dir, "sort")
+        if memory_budget:
+            tables = sort_rows(self.unique_edges_first,
+                               {'edges': self.unique_edges, 'hits': self.unique_edges_hits},
+                               sort_dir, block_rows)
+            edges, hits = tables['edges'], tables['hits']
+            del tables
+        else:
+            order = np.argsort(self.unique_edges_first, kind='stable')
+            edges, hits = self.unique_edges[order], self.unique_edges_hits[order]
+        with open(edges_file, 'w') as f:
+            for lo in range(0, len(edges), block_rows):
+                f.write("".join("%016x,%016x,%x\n" % (src, dst, num) for (src, dst), num in
+                                zip(np.asarray(edges[lo:lo+block_rows]).tolist(),
+                                    np.asarray(hits[lo:lo+block_rows]).tolist())))
+        del edges, hits
+        shutil.rmtree(sort_dir, ignore_errors=True)
+
+        # only list the real code blocks for addr2line, leaving out the
+        # splice points marked by pseudo-addresses ending in 0xffffffff
+        bitmap = CoverageBitmap()
+        with open(blocks_file, 'w') as f:
+            for lo in range(0, len(self.unique_bbs), block_rows):
+                blocks = np.asarray(self.unique_bbs[lo:lo+block_rows])
+                blocks = blocks[(blocks & np.uint64(0xffffffff)) != np.uint64(0xffffffff)]
+                f.write("".join("%016x\n" % addr for addr in blocks.tolist()))
+                bitmap |= CoverageBitmap.from_array(blocks)
+        bitmap.save(bitmap_file)
+
+        num_traces = len(timestamps)
+        num_bbs = len(self.unique_bbs)
+        num_edges = len(self.unique_edges)
         print(" Processed %d traces with a total of %d BBs (%d edges)."
               % (num_traces, num_bbs, num_edges))
 
         print(" Plot data written to %s" % plot_file)
         print(" Unique edges written to %s" % edges_file)
+        print(" Unique blocks written to %s" % blocks_file)
+        print(" Block bitmap written to %s" % bitmap_file)
 
         return
 
-    def callsite_trace_edge(self, edge_str, levels, level=0):
-
-        if level > levels:
-            print("%s abort trace at max level %d..)" % ("->", level))
-            return True
-        if edge_str == "%016x,%016x" % (EXIT_IP, EXIT_IP):
-            print("%s exit_ip..)" % ("->"))
-            return True
+    def code_blocks(self):
+        """
+        Return the positions and addresses of the real code blocks in
+        unique_bbs. Splice points are marked by pseudo-addresses ending in
+        0xffffffff and left out.
+        """
+        if self.block_pos is None:
+            mask = (self.unique_bbs & np.uint64(0xffffffff)) != np.uint64(0xffffffff)
+            self.block_pos = np.flatnonzero(mask)
+            self.block_starts = np.asarray(self.unique_bbs)[self.block_pos]
+        return self.block_pos, self.block_starts
+
+    def covered_blocks(self, addrs):
+        """
+        Return the positions in unique_bbs of the covered blocks containing addrs.
+        Addresses resolved with Ghidra may lie anywhere inside a block, so each
+        one is mapped to the closest block address at or below it.
+        """
+        block_pos, block_starts = self.code_blocks()
+        addrs = np.asarray(addrs, dtype=np.uint64)
+        pos = np.searchsorted(block_starts, addrs, side='right') - 1
+        return block_pos[pos[pos >= 0]]
+
+    def first_seen(self, addrs):
+        """
+        Return the earliest first_seen_key() of the blocks containing addrs,
+        or None if none of them was covered.
+        """
+        pos = self.covered_blocks(addrs)
+        if len(pos) == 0:
+            return None
+        return int(np.min(self.unique_bbs_first[pos]))
+
+    def find_payloads(self, addrs):
+        """
+        Return the trace records of the earliest payload and of the smallest
+        payload covering any of the blocks containing addrs, or None if not covered.
+        """
+        pos = self.covered_blocks(addrs)
+        if len(pos) == 0:
+            return None
+        earliest = int(np.min(self.unique_bbs_first[pos])) >> 32
+        smallest = int(np.min(self.unique_bbs_smallest[pos])) & 0xffffffff
+        return self.index.traces[earliest], self.index.traces[smallest]
+
+    def print_payloads(self, target):
+        """
+        Print the earliest and smallest payloads covering a smatch
+        location (file:line) or a function.
+        """
+        if target in self.line2addr:
+            addrs = self.line2addr[target]
+        elif target in self.func2addr:
+            addrs = list(self.func2addr[target])
+        else:
+            print("Error: Could not find »%s« in addr2line data." % target)
+            return
 
-        if edge_str in self.seen_edges:
-            #print("%sstop on seen edge..)" % ("|"*level))
-            return False
+        payloads = self.find_payloads(addrs)
+        if not payloads:
+            print("No payload covering %s." % target)
+            return
 
-        self.seen_edges.add(edge_str)
+        work_dir = os.path.dirname(self.trace_dir)
+        earliest, smallest = payloads
+        print("earliest: %s (node %d, %ds)" %
+              (os.path.join(work_dir, earliest['payload']), earliest['nid'], earliest['timestamp']))
+        print("smallest: %s (node %d, %d bytes)" %
+              (os.path.join(work_dir, smallest['payload']), smallest['nid'], smallest['payload_size']))
+
+    def gen_smatch_payloads(self, smatch_map):
+        """
+        Write the earliest and smallest payload covering each smatch location.
+        """
+        payloads_file = self.trace_dir + "/smatch_payloads.lst"
+
+        num = 0
+        with open(payloads_file, 'w') as f:
+            for lino in smatch_map.keys():
+                addrs = self.line2addr.get(lino, None)
+                payloads = self.find_payloads(addrs) if addrs else None
+                if payloads:
+                    f.write("%s;%s;%s\n" % (lino, payloads[0]['payload'], payloads[1]['payload']))
+                    num += 1
+
+        print(" Found payloads for %d of %d smatch locations." % (num, len(smatch_map)))
+        print(" Payload list written to %s" % payloads_file)
+
+    def gen_smatch_timeline(self, smatch_map):
+        """
+        Write the first trace covering each smatch location, along with the
+        cumulative number of covered smatch locations over time. Uses the
+        first-seen keys kept by the trace index, so no trace is parsed again.
+        """
+        timeline_file = self.trace_dir + "/smatch_timeline.lst"
+        plot_file = self.trace_dir + "/smatch_coverage.csv"
+
+        first_hits = list()
+        for lino in smatch_map.keys():
+            addrs = self.line2addr.get(lino, None)
+            first = self.first_seen(addrs) if addrs else None
+            if first is not None:
+                first_hits.append((first >> 32, lino))
+        first_hits.sort()
+
+        with open(timeline_file, 'w') as f:
+            for rank, lino in first_hits:
+                trace = self.index.traces[rank]
+                f.write("%d;%d;%s\n" % (trace['timestamp'], trace['nid'], lino))
+
+        num_ranks = len(self.index.traces)
+        cum_hits = np.cumsum(np.bincount([rank for rank, _ in first_hits], minlength=num_ranks))
+        with open(plot_file, 'w') as f:
+            for rank, timestamp in self.trace_timestamps:
+                f.write("%d;%d\n" % (timestamp, int(cum_hits[rank])))
 
-        for addr_str in edge_str.split(','):
-            addr = int(addr_str, 16)
-            func = self.addr2func(addr)
-            lino = self.addr2line(addr)
-            for func in self.smatch_lino_map.get(lino, []):
-                print("%s l_match: %24s at %016x, %s, src: %s" %
-                      ("->", func, addr, lino, self.addr2line(addr)))
-                return True
+        print(" Covered %d of %d smatch locations." % (len(first_hits), len(smatch_map)))
+        print(" First hits written to %s" % timeline_file)
+        print(" Plot data written to %s" % plot_file)
 
+    def callsite_trace_edge(self, edge_str, levels, level=0):
+        src, dst = self.edge_str_to_tuple(edge_str)
+        if (src, dst) == (EXIT_IP, EXIT_IP):
+            start_id = EXIT_EDGE_ID
+        else:
+            start_id = self.back_edges.edge_id(src, dst)
+            if start_id == EXIT_EDGE_ID:
+                print("Error: Could not find edge %s in back-edge index." % edge_str)
+                return False
+
+        # iterative depth-first walk, visiting prior edges in index order
         any_found = False
-        for prior_edge_str in self.get_prior_edge_str(edge_str):
-            #print("%sprior edge: %016x,%016x" % ("| "*level, edge[0], edge[1]))
-            #self.print_addr(edge[0], prefix="| "*level)
-            found = self.callsite_trace_edge(
-                prior_edge_str, levels, level=level+1)
+        stack = [(start_id, level)]
+        while stack:
+            edge_id, level = stack.pop()
+
+            if level > levels:
+                print("%s abort trace at max level %d..)" % ("->", level))
+                any_found = True
+                continue
+            if edge_id == EXIT_EDGE_ID:
+                print("%s exit_ip..)" % ("->"))
+                any_found = True
+                continue
+
+            if edge_id in self.seen_edges:
+                continue
+
+            self.seen_edges.add(edge_id)
+
+            found = False
+            for addr in self.back_edges.edge(edge_id):
+                lino = self.addr2line(addr)
+                for func in self.smatch_lino_map.get(lino, []):
+                    print("%s l_match: %24s at %016x, %s, src: %s" %
+                          ("->", func, addr, lino, self.addr2line(addr)))
+                    found = True
+                    break
+                if found:
+                    break
             if found:
-                #src = self.edge_str_to_tuple(prior_edge_str)[0]
-                #print("%s via: %s - %s" % ("| ", edge_str, self.addr2func(src)))
-                pass
-            any_found |= found
+                any_found = True
+                continue
+
+            priors = self.back_edges.priors(edge_id).tolist()
+            stack.extend((prior_id, level+1) for prior_id in reversed(priors))
         return any_found
 
     def callsite_trace_func(self, func, levels=4):
@@ -334,60 +734,191 @@ class TraceParser:
                     edge_str = "%016x,%016x" % (src, addr)
                     self.callsite_trace_edge(edge_str, levels, level=1)
 
-    def print_callers(self, func, levels=4, level=0, seen_callers=set()):
-        callers = set()
+    def load_call_graph(self):
+        """
+        Get the reverse call graph of the workdir, building it from the trace
+        index and addr2line data unless a current one is cached in the index.
+        """
+        addr2line = self.trace_dir + "/addr2line.lst"
+        manifest = os.path.join(self.index.index_dir, TraceIndex.MANIFEST)
+        if not os.path.exists(addr2line) or not os.path.exists(manifest):
+            print("Call graph needs %s and trace index at %s." % (addr2line, self.index.index_dir))
+            return None
 
-        try:
-            self.func2addrs(func)
-        except KeyError:
+        stamp = [os.stat(manifest).st_mtime_ns, os.stat(addr2line).st_mtime_ns]
+        graph = CallGraphIndex(self.index.index_dir)
+        if graph.load(stamp):
+            return graph
+
+        if not self.load_index():
+            return None
+        if not self.addr2lifu:
+            self.parse_addr2line()
+        if not self.addr2lifu:
+            print("No usable entries in %s." % addr2line)
+            return None
+
+        funcs = sorted(self.func2addr.keys())
+        func_ids = {func: fid for fid, func in enumerate(funcs)}
+
+        # callee: every (inlined) function containing the edge target
+        callee_map = np.array(sorted((addr, func_ids[func])
+                                     for func, addrs in self.func2addr.items() for addr in addrs),
+                              dtype=np.uint64).reshape(-1, 2)
+        # caller: the function the edge source was compiled into
+        caller_addrs = np.array(sorted(self.addr2lifu.keys()), dtype=np.uint64)
+        caller_funcs = np.array([func_ids[self.addr2lifu[addr][1]] for addr in caller_addrs.tolist()],
+                                dtype=np.int64)
+
+        src, dst = self.unique_edges[:, 0], self.unique_edges[:, 1]
+        pos = np.minimum(np.searchsorted(caller_addrs, src), len(caller_addrs)-1)
+        known = caller_addrs[pos] == src
+
+        lo = np.searchsorted(callee_map[:, 0], dst, side='left')
+        hi = np.searchsorted(callee_map[:, 0], dst, side='right')
+        num = np.where(known, hi - lo, 0)
+        rows = np.repeat(np.arange(len(src)), num)
+        offsets = np.arange(len(rows)) - np.repeat(np.cumsum(num) - num, num)
+        callee = callee_map[np.repeat(lo, num) + offsets, 1].astype(np.int64)
+        caller = caller_funcs[pos[rows]]
+
+        # calls within a function add nothing to the call graph
+        external = callee != caller
+        return CallGraphIndex.write(self.index.index_dir, stamp, funcs,
+                                    callee[external], caller[external],
+                                    self.unique_edges_hits[rows[external]])
+
+    def print_callers(self, func, levels=4, as_json=False):
+        graph = self.load_call_graph()
+        if not graph:
+            return
+        tree = graph.caller_tree(func, levels)
+        if not tree:
             print("Error: Could not find »%s« in addr2line data." % func)
             return
 
-        # get possible entry sites - also includes sites that return to us :-/
-        for addr in self.func2addrs(func):
-            for caller in self.addr2caller(addr):
-                if self.is_valid_addr(caller):
-                    callers.add(caller)
-
-        callers -= seen_callers
-        seen_callers.update(callers)
+        if as_json:
+            print(json.dumps(tree, indent=1))
+            return
 
-        if callers:
-            self.print_addr(addr, prefix="| "*level)
-            if level < levels:
-                for func in sorted(set(self.addr2func(addr) for addr in callers)):
-                    self.print_callers(
-                        func, levels, level=level+1, seen_callers=seen_callers)
+        print(func)
+        stack = [(node, 1) for node in reversed(tree['callers'])]
+        while stack:
+            node, level = stack.pop()
+            print("%s%s (%d edges, %d hits)" % ("| "*level, node['func'], node['edges'], node['hits']))
+            stack.extend((child, level+1) for child in reversed(node['callers']))
+
+    def collect_callers(self, func, levels=4):
+        """
+        Return the set of functions calling func within the given depth.
+        """
+        graph = self.load_call_graph()
+        tree = graph.caller_tree(func, levels) if graph else None
+        if not tree:
+            print("Error: Could not find »%s« in addr2line data." % func)
+            return set()
+
+        result = set()
+        stack = list(tree['callers'])
+        while stack:
+            node = stack.pop()
+            result.add(node['func'])
+            stack.extend(node['callers'])
+        return result
 
-    def collect_callers(self, func, levels=4, level=0, seen_callers=set()):
-        callers = set()
 
+def parse_sample_policy(spec):
+    """
+    Parse a sampling policy for non-regular payloads, e.g. "crash=10,kasan=25%,timeout=0".
+    Each exit reason is limited to a number of payloads or a fraction of them.
+    Exit reasons that are not listed are traced in full.
+    """
+    policy = dict()
+    if not spec:
+        return policy
+    for item in spec.split(','):
+        reason, _, limit = item.partition('=')
+        if reason not in ['crash', 'kasan', 'timeout'] or not limit:
+            raise ValueError("Invalid sampling policy »%s«" % item)
         try:
-            self.func2addrs(func)
-        except KeyError:
-            print("Error: Could not find »%s« in addr2line data." % func)
-            return
+            if limit.endswith('%'):
+                policy[reason] = ('rate', float(limit[:-1])/100)
+            else:
+                policy[reason] = ('count', int(limit))
+        except ValueError:
+            raise ValueError("Invalid sampling policy »%s«" % item)
+    return policy
 
-        # get possible entry sites - also includes sites that return to us :-/
-        for addr in self.func2addrs(func):
-            for caller in self.addr2caller(addr):
-                if self.is_valid_addr(caller):
-                    callers.add(caller)
-
-        callers -= seen_callers
-        seen_callers.update(callers)
-
-        result = set(callers)
-        if callers:
-            #self.print_addr(addr, prefix="| "*level)
-            if level < levels:
-                for func in sorted(set(self.addr2func(addr) for addr in callers)):
-                    result |= self.collect_callers(
-                        func, levels, level=level+1, seen_callers=seen_callers)
-        return result
 
+def format_sample_policy(policy):
+    return ",".join("%s=%g%%" % (reason, limit*100) if mode == 'rate' else "%s=%d" % (reason, limit)
+                    for reason, (mode, limit) in sorted(policy.items()))
 
-def kafl_workdir_iterator(work_dir):
+
+def sample_key(seed, nid):
+    # deterministic per-payload hash, independent of the other payloads
+    return int.from_bytes(hashlib.sha1(b"%d:%d" % (seed, nid)).digest(), 'big')
+
+
+def load_payload_samples(samples_file, seed):
+    """
+    Return the payloads listed in a previous traces/payload_samples.lst,
+    if it was sampled with the same seed.
+    """
+    try:
+        with open(samples_file, 'r') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return set()
+    if not lines or not lines[0].endswith(", seed: %d" % seed):
+        return set()
+    return set(lines[1:])
+
+
+def sample_payloads(work_dir, payloads, policy, seed):
+    """
+    Apply the sampling policy to a list of (input_file, nid, exit_reason)
+    and record the selected non-regular payloads in traces/payload_samples.lst.
+
+    The sample only grows as new payloads show up: a rate keeps each payload
+    whose hash falls below the threshold, a count keeps the payloads selected
+    by the previous run and fills up the quota in hash order.
+    """
+    if not policy:
+        return payloads
+
+    samples_file = work_dir + "/traces/payload_samples.lst"
+    previous = load_payload_samples(samples_file, seed)
+
+    buckets = dict()
+    for payload in payloads:
+        buckets.setdefault(payload[2], list()).append(payload)
+
+    selected = list()
+    for reason, bucket in buckets.items():
+        if reason not in policy:
+            selected.extend(bucket)
+            continue
+        mode, limit = policy[reason]
+        if mode == 'rate':
+            threshold = limit * (1 << 160)
+            sample = [p for p in bucket if sample_key(seed, p[1]) < threshold]
+        else:
+            bucket.sort(key=lambda p: (os.path.relpath(p[0], work_dir) not in previous,
+                                       sample_key(seed, p[1])))
+            sample = bucket[:limit]
+        selected.extend(sample)
+        print("Sampled %d of %d %s payloads." % (len(sample), len(bucket), reason))
+
+    with open(samples_file, 'w') as f:
+        f.write("# policy: %s, seed: %d\n" % (format_sample_policy(policy), seed))
+        for input_file, nid, reason in sorted(selected, key=itemgetter(1)):
+            if reason in policy:
+                f.write("%s\n" % os.path.relpath(input_file, work_dir))
+    return selected
+
+
+def kafl_workdir_iterator(work_dir, policy=None, seed=0):
     input_id_time = list()
     start_time = time.time()
     for stats_file in glob.glob(work_dir + "/slave_stats_*"):
@@ -398,32 +929,28 @@ def kafl_workdir_iterator(work_dir):
             raw=False, strict_map_key=False)
         start_time = min(start_time, slave_stats['start_time'])
 
-    # enumerate inputs from corpus/ and match against metainfo in metadata/
-    # TODO: Tracing crashes/timeouts has minimal overall improvement ~1-2%
-    # Probably want to make this optional, and only trace a small sample
-    # of non-regular payloads by default?
-    for input_file in glob.glob(work_dir + "/corpus/[ctrk]*/*"):
-        if not input_file:
-            return None
-        input_id = os.path.basename(input_file).replace("payload_", "")
-        meta_file = work_dir + "/metadata/node_{}".format(input_id)
-        metadata = msgpack.unpackb(
-            read_binary_file(meta_file),
-            raw=False, strict_map_key=False)
-
-        seconds = metadata["info"]["time"] - start_time
-        nid = metadata["id"]
-
+    # enumerate inputs from the workdir's node manifest
+    # Tracing crashes/timeouts has minimal overall improvement ~1-2%, so the
+    # non-regular payloads can optionally be sampled.
+    nodes = load_nodes(work_dir)
+    payloads = list()
+    for node in nodes.values():
+        input_file = os.path.join(work_dir, node['payload'])
+        if os.path.exists(input_file):
+            payloads.append((input_file, node['nid'], node['exit_reason']))
+
+    for input_file, nid, _ in sample_payloads(work_dir, payloads, policy, seed):
+        seconds = nodes[nid]['time'] - start_time
         input_id_time.append([input_file, nid, seconds])
 
     return input_id_time
 
 
-def get_inputs_by_time(data_dir):
+def get_inputs_by_time(data_dir, policy=None, seed=0):
     if (os.path.exists(data_dir + "/stats") and
             os.path.isdir(data_dir + "/corpus/regular") and
             os.path.isdir(data_dir + "/metadata")):
-        input_data = kafl_workdir_iterator(data_dir)
+        input_data = kafl_workdir_iterator(data_dir, policy, seed)
     else:
         print("Unrecognized target directory type «%s». Exit." % data_dir)
         sys.exit()
@@ -479,11 +1006,30 @@ def main():
     parser.add_argument('work_dir', metavar='<work_dir>', type=str,
                         help='target workdir with trace files in /traces/')
     parser.add_argument('-f', '--func', metavar='<func>', type=str,
-                        help='function to search for')
+                        help='print the tree of callers of <func>')
     parser.add_argument('-p', metavar='<n>', type=int, default=default_nproc(),
                         help='number of threads')
     parser.add_argument('-l', metavar='<n>', type=int, default=2,
                         help='max call depths to search')
+    parser.add_argument('-j', '--json', action='store_true',
+                        help='print the caller tree as JSON')
+    parser.add_argument('--payloads', metavar='<file:line|func>', type=str, nargs='?', const='',
+                        help='print the earliest and smallest payloads covering a smatch '
+                             'location or function, or list them for all smatch locations '
+                             'in smatch_payloads.lst')
+    parser.add_argument('--timeline', action='store_true',
+                        help='write the first trace covering each smatch location to '
+                             'smatch_timeline.lst and smatch_coverage.csv')
+    parser.add_argument('--memory-budget', metavar='<MB>', type=int,
+                        help='with -t, parse, merge and report traces using about <MB> of memory')
+    parser.add_argument('--sample', metavar='<policy>', type=str, default=os.environ.get('TRACE_SAMPLE', ''),
+                        help='with -t, only index a sample of non-regular payloads, '
+                             'e.g. "crash=10,kasan=25%%,timeout=0" (default: $TRACE_SAMPLE or all)')
+    parser.add_argument('--sample-seed', metavar='<n>', type=int, default=0,
+                        help='seed for the payload sampling (default: 0)')
+    parser.add_argument('-t', '--update-index', action='store_true',
+                        help='fold new traces into the trace index and regenerate '
+                             'coverage.csv, edges_uniq.lst and blocks_uniq.lst')
 
     args = parser.parse_args()
 
@@ -492,6 +1038,23 @@ def main():
     if not os.path.isdir(trace_dir):
         sys.exit(f"Error: Could not find {trace_dir}.")
 
+    if args.update_index:
+        traces = TraceParser(trace_dir)
+        try:
+            policy = parse_sample_policy(args.sample)
+        except ValueError as e:
+            sys.exit(f"Error: {e}")
+        memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget else None
+        traces.parse_trace_list(args.p, get_inputs_by_time(args.work_dir, policy, args.sample_seed),
+                                memory_budget)
+        traces.gen_reports(memory_budget)
+        return
+
+    if args.func:
+        traces = TraceParser(trace_dir)
+        traces.print_callers(args.func, levels=args.l, as_json=args.json)
+        return
+
     target_smatch_file = args.work_dir + "/target/smatch_warns.txt"
     if os.path.exists(target_smatch_file):
         smatch_file = target_smatch_file
@@ -506,6 +1069,19 @@ def main():
 
     smatch_map = parse_smatch_file(smatch_file)
 
+    if args.timeline:
+        if traces.load_index():
+            traces.gen_smatch_timeline(smatch_map)
+        return
+
+    if args.payloads is not None:
+        if traces.load_index():
+            if args.payloads:
+                traces.print_payloads(args.payloads)
+            else:
+                traces.gen_smatch_payloads(smatch_map)
+        return
+
     for lino in smatch_map.keys():
         addrs = traces.line2addr.get(lino, None)
         if addrs:
@@ -15,6 +15,8 @@ from datetime import timedelta
 
 import humanize
 
+from workdir_manifest import load_nodes
+
 
 def msgpack_read(pathname):
     with open(pathname, 'rb') as f:
@@ -179,13 +181,13 @@ def stats_aggregate(stats):
     }
 
     for node in stats['nodes'].values():
-        reason = node['info']['exit_reason']
+        reason = node['exit_reason']
         last_found = ret['last_found'][reason]
-        ret['last_found'][reason] = max(last_found, node['info']['time'])
+        ret['last_found'][reason] = max(last_found, node['time'])
 
         if reason == "regular":
-            state = node['state']['name']
-            if len(node['fav_bits']) > 0:
+            state = node['state']
+            if node['fav']:
                 fav = "fav_states"
             else:
                 fav = "norm_states"
@@ -219,7 +221,6 @@ def generate_plots(workdir):
 
 def process_workdir(workdir):
     workers = dict()
-    nodes = dict()
 
     stats_path = workdir/"stats"
     stats = msgpack_read(stats_path)
@@ -230,10 +231,7 @@ def process_workdir(workdir):
             workers[num] = msgpack_read(workers_path)
 
     num_nodes = sum([num for num in stats['findings'].values()])
-    for nid in range(num_nodes):
-        nodes_path = workdir/"metadata/node_{:05d}".format(nid)
-        if nodes_path.is_file():
-            nodes[nid] = msgpack_read(nodes_path)
+    nodes = load_nodes(workdir)
 
     stats['name'] = workdir.parent.name
     stats['path'] = workdir
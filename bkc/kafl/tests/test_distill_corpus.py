@@ -0,0 +1,71 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and your use of them is governed by the express license under which they were provided to you ("License"). Unless the License provides otherwise, you may not use, modify, copy, publish, distribute, disclose or transmit this software or the related documents without Intel's prior written permission.
+# This software and the related documents are provided as is, with no express or implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Seed selection of distill_corpus.py from the trace index of a synthetic workdir
+#
+
+import os
+import sys
+
+import lz4.frame as lz4
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from distill_corpus import distill  # noqa: E402
+from smatch_match import TraceParser  # noqa: E402
+
+BASE = 0xffffffff81000000
+
+# node id => (exit reason, payload size, edges)
+NODES = {
+    1: ('regular', 4, [(BASE, BASE + 0x100)]),
+    2: ('regular', 8, [(BASE, BASE + 0x100), (BASE + 0x100, BASE + 0x200)]),
+    3: ('regular', 2, [(BASE + 0x100, BASE + 0x200)]),
+    4: ('regular', 2, [(BASE + 0x100, BASE + 0x200)]),
+    5: ('crash', 1, [(BASE + 0x200, BASE + 0x300)]),
+}
+
+
+def make_workdir(work_dir):
+    trace_dir = os.path.join(work_dir, "traces")
+    os.makedirs(trace_dir)
+
+    input_list = list()
+    for nid, (reason, size, edges) in NODES.items():
+        payload = os.path.join(work_dir, "corpus", reason, "payload_%05d" % nid)
+        os.makedirs(os.path.dirname(payload), exist_ok=True)
+        with open(payload, 'wb') as f:
+            f.write(b"x" * size)
+        with lz4.open(os.path.join(trace_dir, "fuzz_%05d.lst.lz4" % nid), 'wb') as f:
+            for src, dst in edges:
+                f.write(b"%x,%x,1\n" % (src, dst))
+        input_list.append((payload, nid, nid * 10))
+
+    TraceParser(trace_dir).parse_trace_list(1, input_list)
+
+
+@pytest.fixture
+def work_dir(tmp_path):
+    make_workdir(str(tmp_path / "harness" / "workdir"))
+    return str(tmp_path / "harness" / "workdir")
+
+
+def test_distill_regular(work_dir, tmp_path):
+    out_dir = str(tmp_path / "seeds")
+    distill(out_dir, "harness", [work_dir], 'size', ['regular'])
+    # node 4 repeats the trace of node 3, so only one of them is kept
+    assert sorted(os.listdir(os.path.join(out_dir, "harness"))) == ["payload_00001", "payload_00003"]
+
+
+def test_distill_include_replaces_seeds(work_dir, tmp_path):
+    out_dir = str(tmp_path / "seeds")
+    distill(out_dir, "harness", [work_dir], 'size', ['regular'])
+    distill(out_dir, "harness", [work_dir], 'none', ['regular', 'crash'])
+    assert sorted(os.listdir(os.path.join(out_dir, "harness"))) == ["payload_00002", "payload_00005"]
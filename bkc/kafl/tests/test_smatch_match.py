@@ -0,0 +1,94 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and your use of them is governed by the express license under which they were provided to you ("License"). Unless the License provides otherwise, you may not use, modify, copy, publish, distribute, disclose or transmit this software or the related documents without Intel's prior written permission.
+# This software and the related documents are provided as is, with no express or implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Coverage lookups of smatch_match.py on a small synthetic workdir
+#
+
+import os
+import sys
+
+import lz4.frame as lz4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smatch_match import TraceParser  # noqa: E402
+
+BASE = 0xffffffff81000000
+EXIT = 0xffffffffffffffff
+
+# blocks at BASE+0x000, +0x100, +0x200 in trace 1 and +0x300 in trace 2
+TRACES = {
+    1: [(BASE, BASE + 0x100), (BASE + 0x100, EXIT), (EXIT, BASE + 0x200)],
+    2: [(BASE + 0x200, BASE + 0x300)],
+}
+
+
+def make_workdir(work_dir):
+    trace_dir = os.path.join(work_dir, "traces")
+    os.makedirs(trace_dir)
+    os.makedirs(os.path.join(work_dir, "corpus", "regular"))
+
+    input_list = list()
+    for nid, edges in TRACES.items():
+        payload = os.path.join(work_dir, "corpus", "regular", "payload_%05d" % nid)
+        with open(payload, 'wb') as f:
+            f.write(b"x" * (10 - nid))
+        with lz4.open(os.path.join(trace_dir, "fuzz_%05d.lst.lz4" % nid), 'wb') as f:
+            for src, dst in edges:
+                f.write(b"%x,%x,1\n" % (src, dst))
+        input_list.append((payload, nid, nid * 10))
+
+    # addresses in the middle of blocks, as resolved with Ghidra
+    with open(os.path.join(trace_dir, "addr2line.lst"), 'w') as f:
+        for offset, lino in [(0x10, "f.c:1"), (0x140, "f.c:2"), (0x208, "f.c:3"),
+                             (0x3f0, "f.c:4"), (-0x10, "f.c:5")]:
+            f.write("0x%016x: func at f.c:%s:1\n" % (BASE + offset, lino.split(':')[1]))
+
+    traces = TraceParser(trace_dir)
+    traces.parse_trace_list(1, input_list)
+    traces.parse_addr2line()
+    return traces
+
+
+def test_covered_blocks_inside_block(tmp_path):
+    traces = make_workdir(str(tmp_path))
+    blocks = traces.unique_bbs[traces.covered_blocks([BASE + 0x10, BASE + 0x140, BASE + 0x3f0])]
+    assert blocks.tolist() == [BASE, BASE + 0x100, BASE + 0x300]
+    # neither below the first block nor at a splice point
+    assert len(traces.covered_blocks([BASE - 0x10])) == 0
+
+
+def test_timeline_inside_block(tmp_path):
+    traces = make_workdir(str(tmp_path))
+    assert traces.first_seen(traces.line2addr["f.c:3"]) >> 32 == 0
+    assert traces.first_seen(traces.line2addr["f.c:4"]) >> 32 == 1
+    assert traces.first_seen(traces.line2addr["f.c:5"]) is None
+
+    smatch_map = {"f.c:%d" % i: ["func"] for i in range(1, 6)}
+    traces.gen_smatch_timeline(smatch_map)
+    with open(os.path.join(traces.trace_dir, "smatch_timeline.lst")) as f:
+        assert [line.split(';')[2].strip() for line in f] == ["f.c:1", "f.c:2", "f.c:3", "f.c:4"]
+
+
+def test_payloads_inside_block(tmp_path, capsys):
+    traces = make_workdir(str(tmp_path))
+    earliest, smallest = traces.find_payloads(traces.line2addr["f.c:3"])
+    assert (earliest['nid'], smallest['nid']) == (1, 2)
+    earliest, smallest = traces.find_payloads(traces.line2addr["f.c:4"])
+    assert (earliest['nid'], smallest['nid']) == (2, 2)
+    assert traces.find_payloads(traces.line2addr["f.c:5"]) is None
+
+    capsys.readouterr()
+    traces.print_payloads("f.c:2")
+    assert "payload_00001 (node 1, 10s)" in capsys.readouterr().out
+
+    smatch_map = {"f.c:%d" % i: ["func"] for i in range(1, 6)}
+    traces.gen_smatch_payloads(smatch_map)
+    with open(os.path.join(traces.trace_dir, "smatch_payloads.lst")) as f:
+        assert [line.split(';')[0] for line in f] == ["f.c:1", "f.c:2", "f.c:3", "f.c:4"]
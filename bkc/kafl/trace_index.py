@@ -0,0 +1,821 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and
+# your use of them is governed by the express license under which they were
+# provided to you ("License"). Unless the License provides otherwise, you may
+# not use, modify, copy, publish, distribute, disclose or transmit this software
+# or the related documents without Intel's prior written permission.  This
+# software and the related documents are provided as is, with no express or
+# implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Array representation and on-disk index of merged kAFL trace coverage
+#
+# Edges are (src, dst) rows of uint64. The unique edges of a workdir are kept
+# sorted, so that the row number of an edge doubles as its integer edge id.
+#
+
+import os
+import shutil
+
+import msgpack
+import numpy as np
+
+EXIT_IP = 0xffffffffffffffff
+
+EDGE_DTYPE = np.dtype([('src', '<u8'), ('dst', '<u8')])
+
+# prior edge id of the first edge in a trace (the fake EXIT_IP,EXIT_IP edge)
+EXIT_EDGE_ID = -1
+
+
+def first_seen_key(rank, pos):
+    """
+    Order key of a coverage entry: rank of the trace in timestamp order
+    in the upper bits, position of the entry within its trace below.
+    """
+    return (np.int64(rank) << 32) | pos
+
+
+def smallest_payload_key(payload_size, rank):
+    """
+    Order key of a trace by the size of its payload, with the rank of the
+    trace in the lower bits to pick the earliest trace among equal sizes.
+    """
+    return (np.int64(payload_size) << 32) | rank
+
+
+def reduce_coverage(keys, first, counts=None):
+    """
+    Reduce repeated coverage entries to one entry per unique key.
+
+    keys are block addresses (1-d) or rows such as (src, dst) edges (2-d),
+    first holds the first_seen_key() of each entry. Returns the unique keys
+    in sorted order along with their earliest first_seen_key() and, if
+    given, summed counts.
+    """
+    if len(keys) == 0:
+        counts = np.zeros(0, dtype=np.uint64) if counts is not None else None
+        return keys, first, counts
+
+    if keys.ndim == 1:
+        order = np.lexsort((first, keys))
+        keys = keys[order]
+        change = keys[1:] != keys[:-1]
+    else:
+        order = np.lexsort((first,) + tuple(keys[:, i] for i in reversed(range(keys.shape[1]))))
+        keys = keys[order]
+        change = np.any(keys[1:] != keys[:-1], axis=1)
+
+    starts = np.flatnonzero(np.concatenate(([True], change)))
+    if counts is not None:
+        counts = np.add.reduceat(counts[order], starts)
+    return keys[starts], first[order][starts], counts
+
+
+def merge_partials(partials):
+    """
+    Merge coverage partials returned by TraceParser.parse_trace_chunk().
+    """
+    merged = dict()
+    merged['ranks'] = np.concatenate([p['ranks'] for p in partials])
+    merged['edges'], merged['edges_first'], merged['edges_hits'] = reduce_coverage(
+        np.concatenate([p['edges'] for p in partials]),
+        np.concatenate([p['edges_first'] for p in partials]),
+        np.concatenate([p['edges_hits'] for p in partials]))
+    bbs = np.concatenate([p['bbs'] for p in partials])
+    merged['bbs'], merged['bbs_first'], _ = reduce_coverage(
+        bbs, np.concatenate([p['bbs_first'] for p in partials]))
+    _, merged['bbs_smallest'], _ = reduce_coverage(
+        bbs, np.concatenate([p['bbs_smallest'] for p in partials]))
+    back_edges = np.concatenate([p['back_edges'] for p in partials])
+    merged['back_edges'], _, _ = reduce_coverage(
+        back_edges, np.zeros(len(back_edges), dtype=np.int64))
+    trace_edges = np.concatenate([p['trace_edges'] for p in partials])
+    merged['trace_edges'], _, _ = reduce_coverage(
+        trace_edges, np.zeros(len(trace_edges), dtype=np.int64))
+    return merged
+
+
+def edge_ids(edges, queries):
+    """
+    Look up the ids of (src, dst) rows in the sorted unique edges.
+    Returns EXIT_EDGE_ID for edges that are not in the table.
+    """
+    table = np.ascontiguousarray(edges, dtype=np.uint64).view(EDGE_DTYPE).ravel()
+    queries = np.ascontiguousarray(queries, dtype=np.uint64).view(EDGE_DTYPE).ravel()
+    if len(table) == 0:
+        return np.full(len(queries), EXIT_EDGE_ID, dtype=np.int64)
+
+    ids = np.searchsorted(table, queries).astype(np.int64)
+    found = ids < len(table)
+    found[found] = table[ids[found]] == queries[found]
+    ids[~found] = EXIT_EDGE_ID
+    return ids
+
+
+def save_array(path, array):
+    # write to a temporary file first so readers never see a partial index
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+# tables of a partial as returned by TraceParser.parse_trace_chunk()
+PARTIAL_TABLES = ['ranks', 'edges', 'edges_first', 'edges_hits',
+                  'bbs', 'bbs_first', 'bbs_smallest', 'back_edges', 'trace_edges']
+
+# tables holding trace ranks, which move when traces are inserted
+RANK_TABLES = ['edges_first', 'bbs_first', 'bbs_smallest', 'trace_edges']
+
+# key table of each group of merged tables, and how to reduce the value tables
+MERGE_GROUPS = [
+    ('edges', {'edges_first': np.minimum, 'edges_hits': np.add}),
+    ('bbs', {'bbs_first': np.minimum, 'bbs_smallest': np.minimum}),
+    ('back_edges', {}),
+    ('trace_edges', {}),
+]
+
+
+def spill_partial(run_dir, partial):
+    """
+    Store a partial as a sorted run of .npy files for merge_runs().
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    for name in PARTIAL_TABLES:
+        np.save(os.path.join(run_dir, name + ".npy"), partial[name])
+    return run_dir
+
+
+def load_run(run_dir):
+    return {name: np.load(os.path.join(run_dir, name + ".npy"), mmap_mode='r')
+            for name in PARTIAL_TABLES}
+
+
+def _row_view(keys):
+    # 1-d view of key rows that sorts and compares like the rows themselves
+    if keys.ndim == 1:
+        return keys
+    dtype = np.dtype([('f%d' % i, '<u8') for i in range(keys.shape[1])])
+    return np.ascontiguousarray(keys, dtype=np.uint64).view(dtype).ravel()
+
+
+def _row_key(row):
+    return int(row) if np.ndim(row) == 0 else tuple(int(x) for x in row)
+
+
+def reduce_rows(keys, values, ops):
+    """
+    Sort key rows and reduce each value table over equal keys with ops[name].
+    """
+    if keys.ndim == 1:
+        order = np.argsort(keys, kind='stable')
+    else:
+        order = np.lexsort(tuple(keys[:, i] for i in reversed(range(keys.shape[1]))))
+    keys = keys[order]
+    if len(keys) == 0:
+        return keys, values
+    if keys.ndim == 1:
+        change = keys[1:] != keys[:-1]
+    else:
+        change = np.any(keys[1:] != keys[:-1], axis=1)
+    starts = np.flatnonzero(np.concatenate(([True], change)))
+    values = {name: ops[name].reduceat(values[name][order], starts) for name in values}
+    return keys[starts], values
+
+
+def _raw_to_npy(raw_path, npy_path, dtype, shape):
+    with open(npy_path, 'wb') as out:
+        np.lib.format.write_array_header_1_0(out, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': shape})
+        with open(raw_path, 'rb') as f:
+            shutil.copyfileobj(f, out, 1 << 20)
+    os.remove(raw_path)
+
+
+def _read_block(table, lo, hi):
+    # lazy tables may extend a block, e.g. to the end of a group of rows
+    if hasattr(table, 'read_block'):
+        return table.read_block(lo, hi)
+    return np.asarray(table[lo:hi]), hi
+
+
+class LazyTable:
+    """
+    Read-only view of a table that converts each block as it is read.
+    """
+
+    def __init__(self, table, convert):
+        self.table = table
+        self.convert = convert
+        self.shape = np.shape(table)
+        self.dtype = table.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return self.convert(np.asarray(self.table[index]))
+
+
+def merge_runs(runs, key_name, ops, out_dir, block_rows):
+    """
+    K-way merge of runs (dicts of tables) that are sorted by their unique
+    key_name rows, reducing the value tables in ops over equal keys.
+
+    At most block_rows rows of each run are loaded at a time. The merged
+    tables are written to out_dir/<name>.npy.
+    """
+    names = [key_name] + list(ops)
+    pos = [0] * len(runs)
+    last = [None] * len(runs)
+    blocks = list()
+
+    def load(i):
+        keys, hi = _read_block(runs[i][key_name], pos[i], pos[i] + block_rows)
+        block = {key_name: keys}
+        for name in ops:
+            block[name] = np.asarray(runs[i][name][pos[i]:hi])
+        pos[i] = hi
+        last[i] = _row_key(keys[-1]) if hi < len(runs[i][key_name]) and len(keys) else None
+        blocks.append(block)
+
+    for i in range(len(runs)):
+        load(i)
+
+    os.makedirs(out_dir, exist_ok=True)
+    raw_files = {name: open(os.path.join(out_dir, name + ".raw"), 'wb') for name in names}
+    num = 0
+    try:
+        while blocks:
+            keys, values = reduce_rows(np.concatenate([b[key_name] for b in blocks]),
+                                       {name: np.concatenate([b[name] for b in blocks]) for name in ops},
+                                       ops)
+            blocks = list()
+
+            # rows up to the smallest last loaded key of any run are final
+            active = [key for key in last if key is not None]
+            split = len(keys)
+            if active:
+                frontier = min(active)
+                rows = _row_view(keys)
+                frontier_row = np.array([frontier], dtype=np.uint64).view(rows.dtype).ravel()
+                split = int(np.searchsorted(rows, frontier_row, side='right')[0])
+
+            for name in names:
+                table = keys if name == key_name else values[name]
+                raw_files[name].write(np.ascontiguousarray(table[:split]).tobytes())
+            num += split
+
+            if split < len(keys):
+                blocks.append(dict({key_name: keys[split:]},
+                                   **{name: values[name][split:] for name in ops}))
+            if active:
+                for i, key in enumerate(last):
+                    if key == frontier:
+                        load(i)
+    finally:
+        for f in raw_files.values():
+            f.close()
+
+    for name in names:
+        sample = runs[0][name] if runs else np.zeros(0, dtype=np.uint64)
+        shape = (num,) + tuple(np.shape(sample)[1:])
+        _raw_to_npy(os.path.join(out_dir, name + ".raw"), os.path.join(out_dir, name + ".npy"),
+                    sample.dtype, shape)
+    return num
+
+
+def sort_rows(order_key, values, work_dir, block_rows):
+    """
+    Out-of-core sort of the value tables by order_key: sorted runs of
+    block_rows rows are spilled to work_dir and k-way merged by merge_runs().
+    Returns the sorted value tables, memory-mapped from work_dir.
+    """
+    # the row number breaks ties, so merge_runs() never reduces two rows
+    runs = list()
+    for i, lo in enumerate(range(0, len(order_key), block_rows)):
+        hi = min(lo + block_rows, len(order_key))
+        key = np.column_stack((np.asarray(order_key[lo:hi]).astype(np.uint64),
+                               np.arange(lo, hi, dtype=np.uint64)))
+        order = np.lexsort((key[:, 1], key[:, 0]))
+        run_dir = os.path.join(work_dir, "run_%05d" % i)
+        os.makedirs(run_dir, exist_ok=True)
+        np.save(os.path.join(run_dir, "key.npy"), key[order])
+        for name, table in values.items():
+            np.save(os.path.join(run_dir, name + ".npy"), np.asarray(table[lo:hi])[order])
+        runs.append({name: np.load(os.path.join(run_dir, name + ".npy"), mmap_mode='r')
+                     for name in ['key'] + list(values)})
+
+    out_dir = os.path.join(work_dir, "sorted")
+    merge_runs(runs, 'key', {name: np.minimum for name in values}, out_dir,
+               max(1, block_rows // (len(runs) + 1)))
+    return {name: np.load(os.path.join(out_dir, name + ".npy"), mmap_mode='r') for name in values}
+
+
+class BackEdgeIndex:
+    """
+    Back-edge relation of a workdir in CSR form: for edge id i, the ids of
+    all edges seen directly before it in some trace are
+    indices[indptr[i]:indptr[i+1]]. The arrays are memory-mapped on first
+    use, so opening the index of a finished campaign costs nothing.
+    """
+
+    EDGES = "edges.npy"
+    INDPTR = "back_edges_indptr.npy"
+    INDICES = "back_edges_indices.npy"
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self._edges = None
+        self._indptr = None
+        self._indices = None
+
+    def exists(self):
+        return all(os.path.isfile(os.path.join(self.index_dir, f))
+                   for f in [self.EDGES, self.INDPTR, self.INDICES])
+
+    def _load(self):
+        if self._edges is not None:
+            return
+        if not self.exists():
+            raise FileNotFoundError(
+                f"Could not find back-edge index at {self.index_dir}")
+        self._edges = np.load(os.path.join(self.index_dir, self.EDGES), mmap_mode='r')
+        self._indptr = np.load(os.path.join(self.index_dir, self.INDPTR), mmap_mode='r')
+        self._indices = np.load(os.path.join(self.index_dir, self.INDICES), mmap_mode='r')
+
+    def rows(self):
+        """
+        Expand the index back to (src, dst, prior_src, prior_dst) rows.
+        """
+        if not self.exists():
+            return np.zeros((0, 4), dtype=np.uint64)
+        self._load()
+        rows = np.repeat(np.arange(len(self._edges)), np.diff(self._indptr))
+        priors = np.asarray(self._indices)
+        prior_edges = np.full((len(priors), 2), EXIT_IP, dtype=np.uint64)
+        known = priors != EXIT_EDGE_ID
+        prior_edges[known] = self._edges[priors[known]]
+        return np.concatenate((self._edges[rows], prior_edges), axis=1)
+
+    @classmethod
+    def write(cls, index_dir, edges, back_edges):
+        """
+        Store the back-edge relation given as (src, dst, prior_src, prior_dst)
+        rows, with edges being the sorted unique (src, dst) rows of the workdir.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        rows = edge_ids(edges, back_edges[:, :2])
+        priors = edge_ids(edges, back_edges[:, 2:])
+
+        # drop relations of edges outside of the table, then group by edge id
+        valid = rows != EXIT_EDGE_ID
+        rows, priors = rows[valid], priors[valid]
+        order = np.lexsort((priors, rows))
+        indptr = np.zeros(len(edges) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(edges)), out=indptr[1:])
+
+        save_array(os.path.join(index_dir, cls.EDGES), np.asarray(edges, dtype=np.uint64))
+        save_array(os.path.join(index_dir, cls.INDPTR), indptr)
+        save_array(os.path.join(index_dir, cls.INDICES), priors[order])
+        return cls(index_dir)
+
+    @classmethod
+    def write_blocks(cls, index_dir, edges, back_edges, block_rows):
+        """
+        Variant of write() for back_edges rows sorted by (src, dst), which
+        builds the index in blocks of about block_rows rows.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        indptr = np.lib.format.open_memmap(os.path.join(index_dir, cls.INDPTR + ".tmp"), mode='w+',
+                                           dtype=np.int64, shape=(len(edges) + 1,))
+        indptr[:] = 0
+        indices_raw = os.path.join(index_dir, cls.INDICES + ".raw")
+        num = 0
+        with open(indices_raw, 'wb') as f:
+            lo = 0
+            while lo < len(back_edges):
+                hi = min(lo + block_rows, len(back_edges))
+                # keep the relations of an edge together in one block
+                while hi < len(back_edges) and np.array_equal(back_edges[hi, :2], back_edges[hi - 1, :2]):
+                    hi = min(hi + block_rows, len(back_edges))
+                block = np.asarray(back_edges[lo:hi])
+                rows = edge_ids(edges, block[:, :2])
+                if hi < len(back_edges):
+                    cut = np.searchsorted(rows, rows[-1])
+                    if cut > 0:
+                        block, rows, hi = block[:cut], rows[:cut], lo + cut
+                priors = edge_ids(edges, block[:, 2:])
+                valid = rows != EXIT_EDGE_ID
+                rows, priors = rows[valid], priors[valid]
+                order = np.lexsort((priors, rows))
+                uniq, counts = np.unique(rows, return_counts=True)
+                indptr[uniq + 1] += counts
+                f.write(priors[order].astype(np.int64).tobytes())
+                num += len(priors)
+                lo = hi
+        np.cumsum(indptr, out=indptr)
+        indptr.flush()
+        del indptr
+
+        os.replace(os.path.join(index_dir, cls.INDPTR + ".tmp"), os.path.join(index_dir, cls.INDPTR))
+        _raw_to_npy(indices_raw, os.path.join(index_dir, cls.INDICES), np.int64, (num,))
+        return cls(index_dir)
+
+    def relations(self):
+        return BackEdgeRows(self)
+
+    def read_block(self, lo, hi):
+        """
+        Expand the relations at positions lo..hi of the index to
+        (src, dst, prior_src, prior_dst) rows in sorted order. The block is
+        extended to the end of the last edge, so that each block is sorted
+        on its own.
+        """
+        self._load()
+        hi = min(hi, len(self._indices))
+        if hi <= lo:
+            return np.zeros((0, 4), dtype=np.uint64), lo
+        rows = np.searchsorted(self._indptr, np.arange(lo, hi), side='right') - 1
+        hi = int(self._indptr[rows[-1] + 1])
+        rows = np.searchsorted(self._indptr, np.arange(lo, hi), side='right') - 1
+        priors = np.asarray(self._indices[lo:hi])
+        prior_edges = np.full((len(priors), 2), EXIT_IP, dtype=np.uint64)
+        known = priors != EXIT_EDGE_ID
+        prior_edges[known] = self._edges[priors[known]]
+        block = np.concatenate((self._edges[rows], prior_edges), axis=1)
+        order = np.lexsort(tuple(block[:, i] for i in reversed(range(4))))
+        return block[order], hi
+
+    def __len__(self):
+        self._load()
+        return len(self._edges)
+
+    def edge_id(self, src, dst):
+        self._load()
+        return int(edge_ids(self._edges, [[src, dst]])[0])
+
+    def edge(self, eid):
+        self._load()
+        src, dst = self._edges[eid]
+        return int(src), int(dst)
+
+    def priors(self, eid):
+        self._load()
+        if eid == EXIT_EDGE_ID:
+            return self._indices[0:0]
+        return self._indices[self._indptr[eid]:self._indptr[eid+1]]
+
+
+class BackEdgeRows:
+    """
+    Table-like view of the (src, dst, prior_src, prior_dst) rows of a
+    BackEdgeIndex, for merge_runs(). Rows are read in sorted blocks.
+    """
+
+    def __init__(self, index):
+        index._load()
+        self.index = index
+        self.shape = (len(index._indices), 4)
+        self.dtype = np.dtype(np.uint64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_block(self, lo, hi):
+        return self.index.read_block(lo, hi)
+
+
+class TraceIndex:
+    """
+    Persistent merge of all traces ingested so far for a workdir.
+
+    The manifest records each ingested trace file (name, size, mtime) along
+    with its node id, timestamp and payload, in rank order. The merged edge,
+    block and hitcount tables plus the back-edge index are kept as .npy files
+    next to it, so new traces can be folded in without re-parsing the old ones.
+    For each block, the index also keeps the trace with the smallest payload
+    that covered it. The edges of each trace are kept as (rank, src, dst)
+    rows in trace_edges, sorted by rank. Identical traces that were parsed
+    together are only listed once, under the earliest of them; they all
+    share the same 'hash'.
+    """
+
+    MANIFEST = "manifest.msgpack"
+    TABLES = {
+        'edges_first': np.int64,
+        'edges_hits': np.uint64,
+        'bbs': np.uint64,
+        'bbs_first': np.int64,
+        'bbs_smallest': np.int64,
+        'trace_edges': np.uint64,
+    }
+    # row width of the tables that hold rows rather than single values
+    ROW_TABLES = {'trace_edges': 3}
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.reset()
+
+    def reset(self):
+        self.back_edges = None
+        self.rank_map = None
+        self.traces = list()
+        self.edges = np.zeros((0, 2), dtype=np.uint64)
+        self.tables = {name: np.zeros((0, self.ROW_TABLES[name]) if name in self.ROW_TABLES else 0, dtype=dtype)
+                       for name, dtype in self.TABLES.items()}
+
+    def load(self):
+        manifest = os.path.join(self.index_dir, self.MANIFEST)
+        if (not os.path.isfile(manifest) or not BackEdgeIndex(self.index_dir).exists() or
+                not all(os.path.isfile(os.path.join(self.index_dir, name + ".npy"))
+                        for name in self.TABLES)):
+            self.reset()
+            return False
+
+        with open(manifest, 'rb') as f:
+            self.traces = msgpack.unpackb(f.read(), raw=False)
+        self.back_edges = BackEdgeIndex(self.index_dir)
+        self.edges = np.load(os.path.join(self.index_dir, BackEdgeIndex.EDGES), mmap_mode='r')
+        for name in self.TABLES:
+            self.tables[name] = np.load(os.path.join(self.index_dir, name + ".npy"), mmap_mode='r')
+        return True
+
+    def pending(self, records, digest):
+        """
+        Return the trace records that still need to be ingested.
+
+        Indexed traces missing from records, e.g. payloads that are no longer
+        sampled, are kept in the index. A modified trace is checked against
+        its content digest(name) and only causes a full rebuild if it changed.
+        """
+        current = {r['name']: r for r in records}
+        for trace in self.traces:
+            record = current.get(trace['name'], None)
+            if not record or (record['size'] == trace['size'] and
+                              record['mtime'] == trace['mtime']):
+                continue
+            if trace.get('hash') != digest(trace['name']):
+                print("Trace %s changed since it was indexed, rebuilding index.." % trace['name'])
+                self.reset()
+                return list(records)
+            trace['size'] = record['size']
+            trace['mtime'] = record['mtime']
+
+        known = set(trace['name'] for trace in self.traces)
+        kept = len(known - set(current))
+        if kept:
+            print("Keeping %d indexed traces that are no longer listed." % kept)
+        return [r for r in records if r['name'] not in known]
+
+    def add(self, records):
+        """
+        Insert new trace records in timestamp order and return their ranks.
+        First-seen keys of already merged coverage are moved to the new ranks.
+        """
+        combined = self.traces + list(records)
+        order = sorted(range(len(combined)),
+                       key=lambda i: (combined[i]['timestamp'], combined[i]['nid']))
+        new_rank = np.empty(len(combined), dtype=np.int64)
+        new_rank[order] = np.arange(len(combined), dtype=np.int64)
+
+        # applied to the stored tables when they are next merged
+        self.rank_map = new_rank[:len(self.traces)]
+        self.traces = [combined[i] for i in order]
+        return new_rank[len(combined)-len(records):].tolist()
+
+    def remap(self, name, values):
+        """
+        Move the ranks in a stored first-seen or smallest payload table to
+        the trace order established by the last add().
+        """
+        if self.rank_map is None or name not in RANK_TABLES:
+            return values
+        if name == 'bbs_smallest':
+            return ((values >> 32) << 32) | self.rank_map[values & 0xffffffff]
+        if name == 'trace_edges':
+            # ranks only move up in order, so the rows stay sorted
+            ranks = self.rank_map[values[:, 0].astype(np.int64)].astype(np.uint64)
+            return np.column_stack((ranks, values[:, 1:]))
+        return (self.rank_map[values >> 32] << 32) | (values & 0xffffffff)
+
+    def fold(self, partial, ranks):
+        """
+        Merge a partial of newly parsed traces into the index tables.
+        Traces that were requested in ranks but failed to parse are recorded as invalid.
+        """
+        merged = merge_partials([{
+            'ranks': np.zeros(0, dtype=np.int64),
+            'edges': np.asarray(self.edges),
+            'edges_first': self.remap('edges_first', self.tables['edges_first']),
+            'edges_hits': np.asarray(self.tables['edges_hits']),
+            'bbs': np.asarray(self.tables['bbs']),
+            'bbs_first': self.remap('bbs_first', self.tables['bbs_first']),
+            'bbs_smallest': self.remap('bbs_smallest', self.tables['bbs_smallest']),
+            'back_edges': self.back_edges.rows() if self.back_edges else np.zeros((0, 4), dtype=np.uint64),
+            'trace_edges': self.remap('trace_edges', np.asarray(self.tables['trace_edges'])),
+        }, partial])
+
+        parsed = set(partial['ranks'].tolist())
+        for rank in ranks:
+            self.traces[rank]['valid'] = rank in parsed
+
+        self.edges = merged['edges']
+        self.tables['edges_first'] = merged['edges_first']
+        self.tables['edges_hits'] = merged['edges_hits']
+        self.tables['bbs'] = merged['bbs']
+        self.tables['bbs_first'] = merged['bbs_first']
+        self.tables['bbs_smallest'] = merged['bbs_smallest']
+        self.tables['trace_edges'] = merged['trace_edges']
+        self.rank_map = None
+        return merged['back_edges']
+
+    def save(self, back_edges):
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        # the manifest is written last and marks the index as complete
+        manifest = os.path.join(self.index_dir, self.MANIFEST)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+
+        self.back_edges = BackEdgeIndex.write(self.index_dir, self.edges, back_edges)
+        for name in self.TABLES:
+            save_array(os.path.join(self.index_dir, name + ".npy"), self.tables[name])
+
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = os.path.join(self.index_dir, self.MANIFEST)
+        with open(manifest + ".tmp", 'wb') as f:
+            f.write(msgpack.packb(self.traces, use_bin_type=True))
+        os.replace(manifest + ".tmp", manifest)
+
+    def fold_runs(self, run_dirs, ranks, block_rows):
+        """
+        Out-of-core variant of fold() and save(): merge the index with the
+        partials spilled to run_dirs by a k-way merge, holding at most about
+        block_rows rows per run in memory.
+        """
+        os.makedirs(self.index_dir, exist_ok=True)
+        manifest = os.path.join(self.index_dir, self.MANIFEST)
+        if os.path.exists(manifest):
+            os.remove(manifest)
+
+        runs = [load_run(run_dir) for run_dir in run_dirs]
+        parsed = set()
+        for run in runs:
+            parsed.update(run['ranks'].tolist())
+
+        # the current index is merged as one more run
+        current = {name: LazyTable(table, lambda values, name=name: self.remap(name, values))
+                   for name, table in self.tables.items()}
+        current['edges'] = self.edges
+        current['back_edges'] = (self.back_edges.relations() if self.back_edges else
+                                 np.zeros((0, 4), dtype=np.uint64))
+        runs.append(current)
+
+        merge_dir = os.path.join(self.index_dir, "merge")
+        for key_name, ops in MERGE_GROUPS:
+            merge_runs(runs, key_name, ops, merge_dir, block_rows)
+        del runs, current
+
+        edges = np.load(os.path.join(merge_dir, BackEdgeIndex.EDGES), mmap_mode='r')
+        back_edges = np.load(os.path.join(merge_dir, "back_edges.npy"), mmap_mode='r')
+        BackEdgeIndex.write_blocks(merge_dir, edges, back_edges, block_rows)
+        del edges, back_edges
+
+        for name in [BackEdgeIndex.EDGES, BackEdgeIndex.INDPTR, BackEdgeIndex.INDICES] + \
+                [name + ".npy" for name in self.TABLES]:
+            os.replace(os.path.join(merge_dir, name), os.path.join(self.index_dir, name))
+        shutil.rmtree(merge_dir)
+
+        for rank in ranks:
+            self.traces[rank]['valid'] = rank in parsed
+        self.rank_map = None
+        self._write_manifest()
+        self.load()
+
+    def trace_edges(self, rank):
+        """
+        Return the (src, dst) edges listed for the indexed trace at rank.
+        This is empty for the later ones of identical traces parsed together.
+        """
+        table = self.tables['trace_edges']
+        lo, hi = np.searchsorted(table[:, 0], [rank, rank + 1])
+        return np.asarray(table[lo:hi, 1:])
+
+    def timestamps(self):
+        return [(rank, trace['timestamp'])
+                for rank, trace in enumerate(self.traces) if trace['valid']]
+
+
+class CallGraphIndex:
+    """
+    Reverse call graph of a workdir at function level, in CSR form: for
+    function id i, the ids of its calling functions are
+    callers[indptr[i]:indptr[i+1]], along with the number of distinct
+    edges and the total hits of these calls.
+
+    The graph is derived from the trace index and addr2line.lst, and the
+    meta file records the mtimes of both so a stale graph is rebuilt.
+    """
+
+    META = "callgraph.msgpack"
+    TABLES = ['callgraph_indptr', 'callgraph_callers', 'callgraph_edges', 'callgraph_hits']
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.funcs = list()
+        self.func_ids = dict()
+        self.tables = dict()
+
+    def load(self, stamp):
+        meta_file = os.path.join(self.index_dir, self.META)
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file, 'rb') as f:
+            meta = msgpack.unpackb(f.read(), raw=False)
+        if meta['stamp'] != list(stamp):
+            return False
+
+        self.funcs = meta['funcs']
+        self.func_ids = {func: fid for fid, func in enumerate(self.funcs)}
+        for name in self.TABLES:
+            self.tables[name] = np.load(os.path.join(self.index_dir, name + ".npy"), mmap_mode='r')
+        return True
+
+    @classmethod
+    def write(cls, index_dir, stamp, funcs, callee, caller, hits):
+        """
+        Store the graph given as one (callee, caller, hits) entry per edge,
+        with callee and caller being ids into funcs.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        meta_file = os.path.join(index_dir, cls.META)
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+
+        pairs = np.stack((callee, caller), axis=1).astype(np.int64).reshape(-1, 2)
+        pairs, inverse = np.unique(pairs, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        indptr = np.zeros(len(funcs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pairs[:, 0], minlength=len(funcs)), out=indptr[1:])
+
+        save_array(os.path.join(index_dir, 'callgraph_indptr.npy'), indptr)
+        save_array(os.path.join(index_dir, 'callgraph_callers.npy'), pairs[:, 1])
+        save_array(os.path.join(index_dir, 'callgraph_edges.npy'),
+                   np.bincount(inverse, minlength=len(pairs)).astype(np.int64))
+        save_array(os.path.join(index_dir, 'callgraph_hits.npy'),
+                   np.bincount(inverse, weights=hits, minlength=len(pairs)).astype(np.uint64))
+
+        # the meta file is written last and marks the graph as complete
+        with open(meta_file + ".tmp", 'wb') as f:
+            f.write(msgpack.packb({'stamp': list(stamp), 'funcs': list(funcs)}, use_bin_type=True))
+        os.replace(meta_file + ".tmp", meta_file)
+
+        graph = cls(index_dir)
+        graph.load(stamp)
+        return graph
+
+    def callers(self, fid):
+        """
+        Return (caller id, number of edges, hits) of all callers of a function.
+        """
+        lo, hi = self.tables['callgraph_indptr'][fid:fid+2]
+        return zip(self.tables['callgraph_callers'][lo:hi].tolist(),
+                   self.tables['callgraph_edges'][lo:hi].tolist(),
+                   self.tables['callgraph_hits'][lo:hi].tolist())
+
+    def caller_tree(self, func, levels):
+        """
+        Breadth-first search for the callers of func up to the given depth.
+
+        Returns a nested dict {'func', 'edges', 'hits', 'callers': [...]}.
+        Each function appears only once, at the shallowest depth it is reached.
+        """
+        root = {'func': func, 'edges': 0, 'hits': 0, 'callers': []}
+        fid = self.func_ids.get(func, None)
+        if fid is None:
+            return None
+
+        seen = {fid}
+        queue = [(fid, root)]
+        for _ in range(levels):
+            next_queue = list()
+            for fid, node in queue:
+                for caller, edges, hits in self.callers(fid):
+                    if caller in seen:
+                        continue
+                    seen.add(caller)
+                    child = {'func': self.funcs[caller], 'edges': edges, 'hits': hits, 'callers': []}
+                    node['callers'].append(child)
+                    next_queue.append((caller, child))
+            queue = next_queue
+        return root
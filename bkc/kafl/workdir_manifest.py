@@ -0,0 +1,118 @@
+#
+# Copyright (C)  2022  Intel Corporation.
+#
+# This software and the related documents are Intel copyrighted materials, and
+# your use of them is governed by the express license under which they were
+# provided to you ("License"). Unless the License provides otherwise, you may
+# not use, modify, copy, publish, distribute, disclose or transmit this software
+# or the related documents without Intel's prior written permission.  This
+# software and the related documents are provided as is, with no express or
+# implied warranties, other than those that are expressly stated in the License.
+#
+# SPDX-License-Identifier: MIT
+
+#
+# Compact manifest of the corpus nodes of a kAFL workdir
+#
+# Summarizes each metadata/node_* file in one record (node id, exit reason,
+# time, exec time, state, fav flag, payload path and size) and keeps them all in a single
+# msgpack file in the workdir. The manifest also records the mtime and entry
+# count of the metadata directory; while these are unchanged, loading the
+# nodes is a single read of the manifest. Otherwise, only metadata files that
+# are new or were modified since the last update are read again.
+#
+
+import os
+import time
+
+import msgpack
+
+MANIFEST = "nodes.msgpack"
+
+# directories modified this recently may still change within the
+# granularity of their mtime, so their stamp is not trusted yet
+RACY_STAMP_NS = 2 * 10**9
+
+
+def msgpack_read(pathname):
+    with open(pathname, 'rb') as f:
+        return msgpack.unpackb(f.read(), raw=False, strict_map_key=False)
+
+
+def read_node(work_dir, meta_file, mtime):
+    metadata = msgpack_read(meta_file)
+    nid = metadata['id']
+    reason = metadata['info']['exit_reason']
+    payload = "corpus/%s/payload_%05d" % (reason, nid)
+    payload_file = os.path.join(work_dir, payload)
+
+    return {
+        'nid': nid,
+        'exit_reason': reason,
+        'time': metadata['info']['time'],
+        'performance': metadata['info'].get('performance', None),
+        'state': metadata['state']['name'],
+        'fav': len(metadata.get('fav_bits', {})) > 0,
+        'payload': payload,
+        'payload_size': os.path.getsize(payload_file) if os.path.isfile(payload_file) else 0,
+        'mtime': mtime,
+    }
+
+
+def metadata_stamp(meta_dir):
+    # kAFL writes metadata files to a temporary file and renames it, so new
+    # and updated nodes both change the mtime of the directory
+    return [os.stat(meta_dir).st_mtime_ns, len(os.listdir(meta_dir))]
+
+
+def load_nodes(work_dir):
+    """
+    Return the nodes of a kAFL workdir as a dict of node id to record,
+    bringing the workdir's manifest up to date first.
+    """
+    work_dir = str(work_dir)
+    manifest_file = os.path.join(work_dir, MANIFEST)
+    meta_dir = os.path.join(work_dir, "metadata")
+
+    manifest = {'stamp': None, 'nodes': list()}
+    if os.path.isfile(manifest_file):
+        manifest = msgpack_read(manifest_file)
+    nodes = {node['nid']: node for node in manifest['nodes']}
+
+    stamp = metadata_stamp(meta_dir)
+    if manifest['stamp'] == stamp:
+        return nodes
+
+    changed = False
+    seen = set()
+    with os.scandir(meta_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith("node_"):
+                continue
+            nid = int(entry.name[len("node_"):])
+            mtime = entry.stat().st_mtime_ns
+            seen.add(nid)
+
+            node = nodes.get(nid, None)
+            if node and node['mtime'] == mtime:
+                continue
+            nodes[nid] = read_node(work_dir, entry.path, mtime)
+            changed = True
+
+    for nid in set(nodes) - seen:
+        del nodes[nid]
+        changed = True
+
+    if time.time_ns() - stamp[0] < RACY_STAMP_NS:
+        stamp = None
+
+    if changed or manifest['stamp'] != stamp:
+        manifest = {'stamp': stamp, 'nodes': [nodes[nid] for nid in sorted(nodes)]}
+        try:
+            with open(manifest_file + ".tmp", 'wb') as f:
+                f.write(msgpack.packb(manifest, use_bin_type=True))
+            os.replace(manifest_file + ".tmp", manifest_file)
+        except OSError as e:
+            print("Could not update %s: %s" % (manifest_file, e))
+
+    return nodes